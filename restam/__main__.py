@@ -0,0 +1,24 @@
+#!/bin/env/python3
+# coding: utf8
+
+"""Run the restam booking server"""
+
+from pathlib import Path
+import argparse
+import sys
+
+here = Path(__file__).resolve().parent
+for subsystem in ( "bookings", "meals" ):  # Their modules import each other by module name
+    sys.path.append( str( here / subsystem ) )
+
+from server_restam import main
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( description="Restaurant table manager booking server" )
+    parser.add_argument( "config_files", nargs="*", type=Path,
+            default=[ here / "haggerston_main.cfg", here / "haggerston_meals.cfg", here / "haggerston_drinks.cfg", here / "haggerston_takeaways.cfg" ] )
+    parser.add_argument( "--host", default="127.0.0.1" )
+    parser.add_argument( "--port", type=int, default=8632 )
+    parser.add_argument( "--journal-dir", type=Path, default=None )
+    args = parser.parse_args()
+    main( *args.config_files, host=args.host, port=args.port, journal_dir=args.journal_dir )
@@ -0,0 +1,183 @@
+#!/bin/env/python3
+# coding: utf8
+
+"""Synthetic-load benchmarks for the bookings subsystem
+
+Run as a script, from any directory; results are written as JSON and optionally compared with a baseline:
+    python restam/bookings/bench_restam.py --out bench.json --baseline bench_old.json
+Besides timings, the memory the whole store grows by per party is measured with tracemalloc.
+"""
+
+__version__ = ""
+__author__ = "Roy Siu"
+__credits = []
+
+from pathlib import Path
+from typing import Dict, List, Any, Callable
+from collections import OrderedDict
+import argparse
+import json
+import random
+import tempfile
+import time
+import platform
+import gc
+import tracemalloc
+import sys
+from datetime import date, timedelta
+
+if __name__ == "__main__":  # Run as a script, so put restam/meals on sys.path as restam/__main__.py does
+    sys.path.append( str( Path(__file__).resolve().parent.parent / "meals" ) )
+
+from bookings_restam import Restaurant, Timetable
+
+## Scenarios: floors x tables per floor, timing interval, opening hours and number of parties
+SCENARIOS = OrderedDict([
+    ( "small", dict( floors=2, tables_per_floor=10, timing_interval_mins=5, opening_time=1630, closing_time=2300, parties=1000 ) ),
+    ( "medium", dict( floors=4, tables_per_floor=25, timing_interval_mins=1, opening_time=1200, closing_time=2300, parties=10000 ) ),
+    ( "large", dict( floors=8, tables_per_floor=50, timing_interval_mins=1, opening_time=1000, closing_time=2359, parties=100000 ) ),
+])
+
+def write_config( directory:Path, floors:int, tables_per_floor:int, timing_interval_mins:int,
+        opening_time:int, closing_time:int, max_stay:int=120, seed:int=0, **_ ) -> List[Path]:
+    """Write a synthetic main and meals config, returning their paths"""
+    rng = random.Random( seed )
+    floors_and_tables = OrderedDict()
+    joins = OrderedDict()
+    for floor in range( floors ):
+        tables = [ [ floor * 1000 + table, rng.choice( (2, 2, 4, 4, 4, 6, 8) ) ] for table in range( tables_per_floor ) ]
+        floors_and_tables[ str(floor) ] = tables
+        joins[ str(floor) ] = [ [ tables[i][0], tables[i+1][0] ] for i in range( 0, tables_per_floor - 1, 2 ) ]
+    main = directory / "main.cfg"
+    main.write_text( "\n".join([
+            "from collections import OrderedDict",
+            "self.timing_interval_mins = {}".format( timing_interval_mins ),
+            "self.restaurant_name = 'Synthetic'",
+            "self.opening_time = {}".format( opening_time ),
+            "self.final_orders = {}".format( closing_time ),
+            "self.closing_time = {}".format( closing_time ),
+            "self.max_stay = {}".format( max_stay ),
+            "self.floors_and_tables_config = OrderedDict({!r})".format( list( floors_and_tables.items() ) ),
+            "self.common_table_joins_config = OrderedDict({!r})".format( list( joins.items() ) ),
+            "" ]) )
+    meals = directory / "meals.cfg"
+    meals.write_text( "self.meals = {!r}\n".format( { str(key): { "name": "meal {}".format(key), "price": 2.5 * key,
+            "veg": None, "egg_free": None, "dairy_free": None, "nut_free": None } for key in range( 1, 9 ) } ) )
+    return [ main, meals ]
+
+def party_mix( restaurant:Restaurant, parties:int, seed:int=0 ) -> List[ Dict[ str, Any ] ]:
+    """Random add_party arguments: mostly couples and fours, some large groups"""
+    rng = random.Random( seed )
+    moments = range( 0, max( 1, restaurant.timetable.moments - restaurant.stay_moments ) )
+    return [ { "time_start": restaurant.moment_to_time( rng.choice( moments ) ),
+            "meals": { "1": rng.choice( (1, 2, 2, 2, 3, 4, 4, 5, 6, 8, 10) ), "2": rng.choice( (0, 0, 0, 1, 2) ) },
+            "booked": rng.random() < 0.7, "name": "party {}".format( i ),
+            "telephone_no": 7700900000 + i } for i in range( parties ) ]
+
+def best_of( func:Callable, repeat:int=3, number:int=1 ) -> float:
+    """Best wall time per call in seconds"""
+    best = None
+    for _ in range( repeat ):
+        start = time.perf_counter()
+        for _ in range( number ):
+            func()
+        elapsed = ( time.perf_counter() - start ) / number
+        best = elapsed if best is None else min( best, elapsed )
+    return best
+
+def run_scenario( name:str, repeat:int=3, **scenario ) -> Dict[ str, float ]:
+    """Time the bookings hot paths for one scenario, in seconds"""
+    results = OrderedDict()
+    with tempfile.TemporaryDirectory() as directory:
+        config_files = write_config( Path(directory), **scenario )
+        results["restaurant_init_uncached"] = best_of( lambda: Restaurant( *config_files, config_cache=False ), repeat )
+        Restaurant( *config_files )  # Warm the config cache
+        results["restaurant_init_cached"] = best_of( lambda: Restaurant( *config_files ), repeat )
+        restaurant = Restaurant( *config_files )
+    
+    results["timetable_build"] = best_of( lambda: Timetable( restaurant.opening_time, restaurant.closing_time, restaurant.timing_interval_mins,
+            restaurant.floors_and_tables_config, restaurant.common_table_joins_config ), repeat )
+    
+    mix = party_mix( restaurant, scenario["parties"] )
+    start = time.perf_counter()
+    for kwargs in mix:
+        restaurant.add_party( **kwargs )
+    results["add_party"] = ( time.perf_counter() - start ) / len( mix )
+    for iden in range( 0, len( mix ), 3 ):
+        restaurant.complete_party( iden=iden )
+    
+    results["status_views"] = best_of( lambda: ( len( restaurant.transactions.pending_transcations ),
+            len( restaurant.transactions.completed_transcations ), len( restaurant.transactions.cancelled_transcations ) ), repeat, 100 )
+    times = [ kwargs["time_start"] for kwargs in mix[:1000] ]
+    results["time_to_moment"] = best_of( lambda: [ restaurant.time_to_moment( t ) for t in times ], repeat ) / len( times )
+    moments = list( range( restaurant.timetable.moments ) )
+    results["moment_to_time"] = best_of( lambda: [ restaurant.moment_to_time( m ) for m in moments ], repeat ) / len( moments )
+    results["find_free_tables"] = best_of( lambda: [ restaurant.find_free_tables( t, 4 ) for t in times[:100] ], repeat ) / len( times[:100] )
+    results["timetable_str"] = best_of( lambda: str( restaurant.timetable ), repeat )
+    return results
+
+def store_bytes_per_party( parties:int, parties_per_evening:int=400, seed:int=0, **scenario ) -> float:
+    """Bytes the whole store grows by per party added: the parties and their indexes, meal ledger,
+    timetable, analytics and dietary rollups. Parties are spread over evenings of parties_per_evening,
+    so per-evening timetable rows are counted in proportion.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        restaurant = Restaurant( *write_config( Path(directory), **scenario ), config_cache=False )
+    mix = party_mix( restaurant, parties, seed )
+    first_evening = date( 2000, 1, 3 )
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for i, kwargs in enumerate( mix ):
+            restaurant.service_date = first_evening + timedelta( days=i // parties_per_evening )
+            restaurant.add_party( **kwargs )
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    return sum( stat.size_diff for stat in after.compare_to( before, "filename" ) ) / len( mix )
+
+def compare( results:dict, baseline:dict, threshold:float=1.25 ) -> List[str]:
+    """Lines describing each benchmark against the baseline, flagging slowdowns past threshold"""
+    lines = []
+    for scenario, timings in results["scenarios"].items():
+        for bench, seconds in timings.items():
+            before = baseline.get( "scenarios", {} ).get( scenario, {} ).get( bench )
+            if not before:
+                continue
+            ratio = seconds / before
+            flag = "  REGRESSION" if ratio > threshold else ""
+            lines.append( "{0}.{1}: {2:.3g}s vs {3:.3g}s ({4:.2f}x){5}".format( scenario, bench, seconds, before, ratio, flag ) )
+    for scenario, size in results.get( "bytes_per_party", {} ).items():
+        before = baseline.get( "bytes_per_party", {} ).get( scenario )
+        if not before:
+            continue
+        ratio = size / before
+        flag = "  REGRESSION" if ratio > threshold else ""
+        lines.append( "{0}.bytes_per_party: {1:.0f}B vs {2:.0f}B ({3:.2f}x){4}".format( scenario, size, before, ratio, flag ) )
+    return lines
+
+def main( scenarios:List[str], out:Path=None, baseline:Path=None, repeat:int=3, threshold:float=1.25 ) -> dict:
+    results = { "python": platform.python_version(), "machine": platform.machine(), "scenarios": OrderedDict(),
+            "bytes_per_party": OrderedDict() }
+    for name in scenarios:
+        print( "Running {}...".format(name) )
+        results["scenarios"][name] = run_scenario( name, repeat, **SCENARIOS[name] )
+        results["bytes_per_party"][name] = store_bytes_per_party( **SCENARIOS[name] )
+    if out is not None:
+        out.write_text( json.dumps( results, indent=2 ) )
+    if baseline is not None:
+        lines = compare( results, json.loads( baseline.read_text() ), threshold )
+        print( "\n".join( lines ) )
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( description="Benchmark the bookings subsystem" )
+    parser.add_argument( "scenarios", nargs="*", default=[ "small", "medium" ], choices=list( SCENARIOS ) )
+    parser.add_argument( "--out", type=Path, default=Path("bench_restam.json") )
+    parser.add_argument( "--baseline", type=Path, default=None )
+    parser.add_argument( "--repeat", type=int, default=3 )
+    parser.add_argument( "--threshold", type=float, default=1.25, help="slowdown ratio reported as a regression" )
+    args = parser.parse_args()
+    main( args.scenarios, args.out, args.baseline, args.repeat, args.threshold )
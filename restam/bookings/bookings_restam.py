@@ -8,10 +8,33 @@ __author__ = "Roy Siu"
 __credits = []
 
 from pathlib import Path
-from typing import Dict, Tuple, List, Any, Callable
-from copy import copy, deepcopy
-from collections import OrderedDict
+from typing import Dict, Tuple, List, Any, Callable, Mapping, Iterable, Iterator
+from types import MappingProxyType
+from collections import OrderedDict, Counter
+from heapq import heappush, heappop
+from array import array
+from bisect import bisect_left, bisect_right, insort
 import sys
+import logging
+from time import perf_counter
+import os
+import pickle
+import hashlib
+import json
+import csv
+import io
+import struct
+import mmap
+import weakref
+from functools import wraps
+from datetime import date
+
+try:
+    from ..meals.meals_restam import TransactionListener, MealIndex, DietaryRollup, dietary_mask, VEG_LEVELS
+except ImportError:  # Imported by module name, with restam/meals put on sys.path by the caller (see restam/__main__.py)
+    if __name__ == "__main__":  # Run as a script, with no caller to do it
+        sys.path.append( str( Path(__file__).resolve().parent.parent / "meals" ) )
+    from meals_restam import TransactionListener, MealIndex, DietaryRollup, dietary_mask, VEG_LEVELS
 
 ## Create type signatures
 #meal_config_typing = Dict[ str, Any ]
@@ -19,6 +42,122 @@ import sys
 
 meals_data_typing = Dict[ str, int ]
 
+logger = logging.getLogger( __name__ )
+
+### Metrics
+
+class Histogram( object ):
+    """Latency histogram with fixed power-of-two microsecond buckets"""
+    BUCKETS = tuple( 2 ** i for i in range( 0, 24 ) )  # 1us .. ~8s, then overflow
+    
+    def __init__( self ) -> None:
+        self.counts = [0] * ( len( self.BUCKETS ) + 1 )
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def observe( self, seconds:float ) -> None:
+        self.counts[ min( bisect_left( self.BUCKETS, seconds * 1e6 ), len( self.BUCKETS ) ) ] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+    
+    def quantile( self, q:float ) -> float:
+        """Upper bound, in seconds, of the bucket holding quantile q"""
+        target, seen = q * self.count, 0
+        for bucket, count in enumerate( self.counts ):
+            seen += count
+            if count and seen >= target:
+                return self.BUCKETS[bucket] / 1e6 if bucket < len( self.BUCKETS ) else self.max
+        return 0.0
+    
+    def snapshot( self ) -> Dict[ str, float ]:
+        return { "count": self.count, "sum": self.total, "max": self.max,
+                "p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99) }
+
+class MetricsRegistry( object ):
+    """In-process counters and latency histograms
+    
+    Timing is off until enabled. Instrumented methods are only swapped for their timed
+    wrappers while enabled, so disabled metrics cost nothing per call.
+    Exporters are callables taking a snapshot dict (see TextFileExporter).
+    """
+    def __init__( self ) -> None:
+        self._enabled = False
+        self._instrumented = []  # (class, attribute name, plain function, timed function)
+        self.exporters = []
+        self.reset()
+    
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+    @enabled.setter
+    def enabled( self, value:bool ) -> None:
+        self._enabled = bool( value )
+        for owner, name, func, timed in self._instrumented:
+            setattr( owner, name, timed if self._enabled else func )
+    
+    def register( self, owner:type, name:str, func:Callable, timed:Callable ) -> None:
+        self._instrumented.append( ( owner, name, func, timed ) )
+        setattr( owner, name, timed if self._enabled else func )
+    
+    def reset( self ) -> None:
+        self.counters = Counter()
+        self.histograms = {}
+    
+    def inc( self, name:str, amount:int=1 ) -> None:
+        self.counters[name] += amount
+    
+    def observe( self, name:str, seconds:float ) -> None:
+        histogram = self.histograms.get( name )
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe( seconds )
+    
+    def snapshot( self ) -> Dict[ str, Any ]:
+        return { "counters": dict( self.counters ),
+                "histograms": { name: histogram.snapshot() for name, histogram in self.histograms.items() } }
+    
+    def export( self ) -> None:
+        snapshot = self.snapshot()
+        for exporter in self.exporters:
+            exporter( snapshot )
+
+class TextFileExporter( object ):
+    """Write snapshots as 'name value' lines, replacing the file each time"""
+    def __init__( self, path:Path ) -> None:
+        self.path = Path( path )
+    
+    def __call__( self, snapshot:Dict[ str, Any ] ) -> None:
+        lines = [ "{0} {1}".format( name, value ) for name, value in sorted( snapshot["counters"].items() ) ]
+        for name, stats in sorted( snapshot["histograms"].items() ):
+            lines.extend( "{0}_seconds_{1} {2}".format( name, stat, value ) for stat, value in sorted( stats.items() ) )
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text( "\n".join( lines ) + "\n" )
+        os.replace( str(tmp_path), str(self.path) )
+
+metrics = MetricsRegistry()
+
+def report_error( where:str, error:Exception, detail:str="" ) -> None:
+    """Count an error against the function it happened in and log it"""
+    metrics.inc( "{}.errors".format(where) )
+    logger.error( "Error in %s: %s%s", where, error.args, " ({})".format(detail) if detail else "" )
+
+class FrozenMeals( dict ):
+    """Read-only meal order, so one can be shared by every party that ordered the same
+    (see Transaction.shared_meals). Copy it with dict() to get a mutable one.
+    """
+    __slots__ = ( "__weakref__", )
+    
+    def __readonly( self, *args, **kwargs ):
+        raise TypeError( "meals are read-only, change them through modify_meals()" )
+    
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = __readonly
+    
+    def __reduce__(self):
+        return ( FrozenMeals, ( dict(self), ) )
+
 ### Exeption classes
 
 class IdentityError(Exception):
@@ -27,10 +166,36 @@ class IdentityError(Exception):
         self.message = message
         self.func = func
 
+class BatchError(Exception):
+    """Raise when add_parties() rejects a batch; errors holds (batch index, exception) for every problem"""
+    def __init__( self, message, errors:List[ Tuple[ int, Exception ] ]=() ):
+        super().__init__( message )
+        self.errors = list( errors )
+
 ### Decorators
 
-def check_iden_exists( func:Callable, *args, **kwargs ):
-    """Check that variable 'iden' exists within self.transactions"""
+class instrumented( object ):
+    """Method decorator: count calls and time them in metrics, when metrics are enabled"""
+    def __init__( self, func:Callable ) -> None:
+        self.func = func
+    
+    def __set_name__( self, owner:type, name:str ) -> None:
+        func = self.func
+        @wraps( func )
+        def _timed( self, *args, **kwargs ):
+            metrics.inc( "{}.calls".format(name) )
+            start = perf_counter()
+            try:
+                return func( self, *args, **kwargs )
+            finally:
+                metrics.observe( name, perf_counter() - start )
+        metrics.register( owner, name, func, _timed )
+
+def check_iden_exists( func:Callable, *args, allow_archived:bool=False, **kwargs ):
+    """Check that variable 'iden' exists within self.transactions
+    Archived parties are read-only copies, so they only pass for check_iden_known.
+    """
+    @wraps( func )
     def _inner( self, *args, **kwargs ):
         try:
             if not ( "iden" in kwargs ):
@@ -39,20 +204,79 @@ def check_iden_exists( func:Callable, *args, **kwargs ):
                 raise IdentityError( "iden is not str", func )
             if not ( kwargs["iden"] in self.transactions ):
                 raise IdentityError( "iden does not exist", func )
+            if not ( allow_archived or kwargs["iden"] in self.transactions.transactions ):
+                raise IdentityError( "iden is archived", func )
         except IdentityError as e:  # Catch-all
-            print( "Error in {0}: {1}".format( func, e.args ) )
+            report_error( func.__name__, e )
             raise  # Re-raise error for handling
         else:
             return func( self, **kwargs )
     return _inner
 
+def check_iden_known( func:Callable ):
+    """Check that variable 'iden' exists within self.transactions, live or archived"""
+    return check_iden_exists( func, allow_archived=True )
+
+def journalled( func:Callable ):
+    """Append each successful call of a Restaurant mutation to self.journal"""
+    @wraps( func )
+    def _inner( self, *args, **kwargs ):
+        result = func( self, *args, **kwargs )
+        if ( self.journal is not None ) and not self._replaying:
+            self.journal.append( func.__name__, args, kwargs, self.service_date )
+            if self.journal.records_since_snapshot >= self.journal.snapshot_every:
+                self.snapshot()
+        return result
+    return _inner
+
+### Streaming exporters
+
+def iter_jsonl( rows:Iterable[dict] ) -> Iterator[str]:
+    """Yield one JSON Lines record per row"""
+    for row in rows:
+        yield json.dumps( row ) + "\n"
+
+def iter_csv( rows:Iterable[dict], fieldnames:List[str] ) -> Iterator[str]:
+    """Yield a CSV header, then one CSV line per row"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter( buffer, fieldnames=fieldnames, lineterminator="\n" )
+    writer.writeheader()
+    for row in rows:
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow( row )
+    yield buffer.getvalue()
+
+def stream_to( chunks:Iterable[str], out ) -> None:
+    """Write chunks as they are produced to a text file, binary file or socket"""
+    if hasattr( out, "sendall" ):
+        for chunk in chunks:
+            out.sendall( chunk.encode("utf-8") )
+    elif isinstance( out, ( io.RawIOBase, io.BufferedIOBase ) ):
+        for chunk in chunks:
+            out.write( chunk.encode("utf-8") )
+    else:
+        for chunk in chunks:
+            out.write( chunk )
+
 ### Classes
 
 class Transaction( object ):
-    """Handle transaction operations"""
+    """Handle transaction operations
+    
+    Parties are also indexed by status; each Party notifies its owning store when
+    its status changes, so the status views never scan the whole store.
+    """
     def __init__( self ):
         self._transactions = OrderedDict()
         self.__next_transaction_no = 0
+        self._by_status = { 0: {}, 1: {}, 2: {} }  # status: {iden: party}
+        self._status_views = { status: MappingProxyType(index) for status, index in self._by_status.items() }
+        self.index = PartyIndex()
+        self.listeners = []  # TransactionListener objects, notified of every change
+        self.archive = None  # Archive of finished parties, see archive_parties()
+        self._meals = weakref.WeakValueDictionary()  # Sorted meal items: FrozenMeals, dropped once no party holds them
     
     def __str__(self):
         pass
@@ -64,96 +288,924 @@ class Transaction( object ):
         for val in self._transactions:
             yield val
     
+    def __contains__( self, iden ):
+        return ( iden in self._transactions ) or ( ( self.archive is not None ) and ( iden in self.archive ) )
+    
+    def __len__(self):
+        return len( self._transactions )
+    
     @property
     def transactions(self):
         return self._transactions
     
     @property
-    def pending_transcations(self) -> dict:
-        pending = {}
-        for transaction in self._transactions:
-            if self._transactions[transaction].pending:
-                pending[transaction] = self._transactions[transaction]
-        return pending
+    def pending_transcations(self) -> Mapping[ int, "Party" ]:
+        """Read-only live view of pending parties"""
+        return self._status_views[0]
     
     @property
-    def completed_transcations(self) -> dict:
-        completed = {}
-        for transaction in self._transactions:
-            if self._transactions[transaction].complete:
-                completed[transaction] = self._transactions[transaction]
-        return completed
+    def completed_transcations(self) -> Mapping[ int, "Party" ]:
+        """Read-only live view of completed parties"""
+        return self._status_views[1]
     
     @property
-    def cancelled_transcations(self) -> dict:
-        cancelled = {}
-        for transaction in self._transactions:
-            if self._transactions[transaction].cancelled:
-                cancelled[transaction] = self._transactions[transaction]
-        return cancelled
-    
-    def add( self, party ):
-        self._transactions[ self.__next_transaction_no ] = party
+    def cancelled_transcations(self) -> Mapping[ int, "Party" ]:
+        """Read-only live view of cancelled parties"""
+        return self._status_views[2]
+    
+    @property
+    def next_iden(self) -> int:
+        return self.__next_transaction_no
+    
+    def reserve_idens( self, next_iden:int ) -> None:
+        """Never hand out an iden below next_iden, e.g. one already in the archive"""
+        self.__next_transaction_no = max( self.__next_transaction_no, next_iden )
+    
+    def shared_meals( self, meals:meals_data_typing ) -> FrozenMeals:
+        """The one read-only meal dict in this store for a meal order"""
+        key = tuple( sorted( meals.items() ) )
+        shared = self._meals.get( key )
+        if shared is None:
+            shared = self._meals[key] = meals if isinstance( meals, FrozenMeals ) else FrozenMeals( meals )
+        return shared
+    
+    def add( self, party ) -> int:
+        iden = self.__next_transaction_no
+        self._transactions[ iden ] = party
         self.__next_transaction_no += 1
+        party.iden = iden
+        party.store = self
+        party.meals = self.shared_meals( party.meals )
+        self._by_status[ party.status ][ iden ] = party
+        self.index.add( iden, party )
+        for listener in self.listeners:
+            listener.party_added( iden, party )
+        return iden
+    
+    def status_changed( self, party, old_status:int, new_status:int ) -> None:
+        """Called by Party when its status is set"""
+        self._by_status[old_status].pop( party.iden, None )
+        self._by_status[new_status][ party.iden ] = party
+        for listener in self.listeners:
+            listener.status_changed( party, old_status, new_status )
+    
+    def meals_changed( self, party, meals_add:meals_data_typing ) -> None:
+        """Called by Party when its meals are modified"""
+        for listener in self.listeners:
+            listener.meals_changed( party, meals_add )
+    
+    def seating_changed( self, party, start:int, end:int, sign:int ) -> None:
+        """Called by Restaurant when a party is seated (sign 1) or leaves (sign -1) for moments start..end-1"""
+        for listener in self.listeners:
+            listener.seating_changed( party, start, end, sign )
     
     #@check_iden_exists
     def get( self, iden ):
-        return self._transactions[ iden ]
+        """Live party, or a read-only copy of an archived one"""
+        try:
+            return self._transactions[ iden ]
+        except KeyError:
+            if ( self.archive is not None ) and ( iden in self.archive ):
+                return self.archive.get( iden )
+            raise
+    
+    def archive_parties( self, idens:Iterable[int] ) -> List[int]:
+        """Move finished (complete or cancelled) parties out of the live store into the archive
+        Only parties the archive now holds are removed; their idens are returned.
+        """
+        parties = [ self._transactions[iden] for iden in idens if self._transactions[iden].status != 0 ]
+        stored = set( self.archive.append( parties ) )
+        for party in parties:
+            if party.iden not in stored:
+                report_error( "archive_parties", IdentityError( "iden {} is archived as another party".format( party.iden ) ) )
+        parties = [ party for party in parties if party.iden in stored ]
+        for party in parties:
+            iden = party.iden
+            del self._transactions[iden]
+            self._by_status[ party.status ].pop( iden, None )
+            self.index.discard( iden, party )
+            party.store = None
+            for listener in self.listeners:
+                listener.party_archived( iden, party )
+        return [ party.iden for party in parties ]
+    
+    CSV_FIELDS = [ "iden", "time_start", "time_length", "covers", "booked", "name", "caravan_no", "telephone_no",
+            "status", "meals", "tables", "additional_notes" ]
+    
+    @staticmethod
+    def party_row( iden:int, party:"Party" ) -> dict:
+        return { "iden": iden, "time_start": party.time_start, "time_length": party.time_length, "covers": party.covers,
+                "booked": party.booked, "name": party.name, "caravan_no": party.caravan_no, "telephone_no": party.telephone_no,
+                "status": party.status, "meals": party.meals, "tables": party.tables, "additional_notes": party.additional_notes }
+    
+    def iter_rows( self ) -> Iterator[dict]:
+        for iden, party in self._transactions.items():
+            yield self.party_row( iden, party )
+    
+    def iter_jsonl( self ) -> Iterator[str]:
+        return iter_jsonl( self.iter_rows() )
+    
+    def iter_csv( self ) -> Iterator[str]:
+        rows = ( dict( row, meals=json.dumps( row["meals"] ), tables=json.dumps( row["tables"] ) ) for row in self.iter_rows() )
+        return iter_csv( rows, self.CSV_FIELDS )
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_status_views"]  # mappingproxy cannot be pickled
+        del state["_meals"]  # Nor can weak references; parties keep sharing their meals through the pickle memo
+        state["archive"] = None  # Memory-mapped, reattached by the owner
+        return state
+    
+    def __setstate__( self, state ):
+        self.__dict__.update( state )
+        self._status_views = { status: MappingProxyType(index) for status, index in self._by_status.items() }
+        self._meals = weakref.WeakValueDictionary()
+        for party in self._transactions.values():
+            party.meals = self.shared_meals( party.meals )
+    
+    def search( self, **criteria ) -> "OrderedDict[int, Party]":
+        """Parties matching every criterion, live or archived, in iden order (see PartyIndex.CATEGORIES)"""
+        found = None
+        for category, search_term in criteria.items():
+            if category == "status":
+                status = PartyIndex.STATUSES.get( search_term, search_term )
+                matches = set( self._by_status[status] )
+                if self.archive is not None:
+                    matches |= self.archive.status_idens( status )
+            else:
+                matches = self.index.lookup( category, search_term )
+                if self.archive is not None:
+                    matches |= self.archive.index.lookup( category, search_term )
+            found = matches if found is None else found & matches
+        return OrderedDict( ( iden, self.get(iden) ) for iden in sorted( found or () ) )
+
+class PartyIndex( object ):
+    """Secondary indexes over parties, kept up to date as parties are added
+    
+    Names are matched case-insensitively: exactly, by prefix (bisect over the sorted
+    names) or fuzzily (by shared trigrams).
+    
+    Sized for a season of parties: a key held by one party maps to its bare iden, and
+    only becomes a set once parties share it. Each distinct name gets a number, and
+    trigram postings are arrays of those numbers; start times are one sorted array.
+    """
+    CATEGORIES = ( "name", "name_prefix", "name_fuzzy", "telephone_no", "caravan_no", "time_start", "status" )
+    TERM_TYPES = { "name": str, "name_prefix": str, "name_fuzzy": str, "telephone_no": int, "caravan_no": int, "time_start": int }
+    STATUSES = OrderedDict( ( ( "pending", 0 ), ( "complete", 1 ), ( "cancelled", 2 ) ) )
+    IDEN_BITS = 40  # Start times are packed as time_start << IDEN_BITS | iden
+    
+    def __init__( self, fuzzy_threshold:float=0.4 ) -> None:
+        self.fuzzy_threshold = fuzzy_threshold
+        self._name_nos = {}  # name: name number
+        self._names = []  # name number: name, None once no party holds it
+        self._name_idens = []  # name number: iden or {iden}
+        self._sorted_names = []
+        self._trigrams = {}  # trigram: array of name numbers
+        self._telephone_nos = {}  # telephone_no: iden or {iden}
+        self._caravan_nos = {}  # caravan_no: iden or {iden}
+        self._times = array( "q" )  # Sorted time_start << IDEN_BITS | iden
+    
+    @staticmethod
+    def trigrams( name:str ) -> set:
+        padded = "  {} ".format( name )
+        return { padded[i:i+3] for i in range( len(padded) - 2 ) }
+    
+    @staticmethod
+    def _add_iden( held, iden:int ):
+        """A key's idens with iden added: the bare iden if none were held, else a set"""
+        if held is None:
+            return iden
+        if isinstance( held, set ):
+            held.add( iden )
+            return held
+        return held if held == iden else { held, iden }
+    
+    @staticmethod
+    def _discard_iden( held, iden:int ):
+        """A key's idens without iden, None if none are left"""
+        if isinstance( held, set ):
+            held.discard( iden )
+            return ( next( iter( held ) ) if len( held ) == 1 else held ) if held else None
+        return None if held == iden else held
+    
+    @staticmethod
+    def _idens( held ) -> set:
+        if held is None:
+            return set()
+        return set( held ) if isinstance( held, set ) else { held }
+    
+    def __time_key( self, time_start:int, iden:int ) -> int:
+        return ( time_start << self.IDEN_BITS ) | iden
+    
+    def add( self, iden:int, party:"Party" ) -> None:
+        name = party.name.lower()
+        name_no = self._name_nos.get( name )
+        if name_no is None:
+            name_no = self._name_nos[name] = len( self._names )
+            self._names.append( name )
+            self._name_idens.append( None )
+            insort( self._sorted_names, name )
+            for gram in self.trigrams( name ):
+                self._trigrams.setdefault( gram, array( "i" ) ).append( name_no )
+        self._name_idens[name_no] = self._add_iden( self._name_idens[name_no], iden )
+        for lookup, key in ( ( self._telephone_nos, party.telephone_no ), ( self._caravan_nos, party.caravan_no ) ):
+            lookup[key] = self._add_iden( lookup.get( key ), iden )
+        insort( self._times, self.__time_key( party.time_start, iden ) )
+    
+    def discard( self, iden:int, party:"Party" ) -> None:
+        name = party.name.lower()
+        name_no = self._name_nos[name]
+        self._name_idens[name_no] = self._discard_iden( self._name_idens[name_no], iden )
+        if self._name_idens[name_no] is None:
+            del self._name_nos[name]
+            self._names[name_no] = None  # Numbers are not reused, so postings never need rewriting
+            del self._sorted_names[ bisect_left( self._sorted_names, name ) ]
+            for gram in self.trigrams( name ):
+                self._trigrams[gram].remove( name_no )
+                if not self._trigrams[gram]:
+                    del self._trigrams[gram]
+        for lookup, key in ( ( self._telephone_nos, party.telephone_no ), ( self._caravan_nos, party.caravan_no ) ):
+            held = self._discard_iden( lookup[key], iden )
+            if held is None:
+                del lookup[key]
+            else:
+                lookup[key] = held
+        time_key = self.__time_key( party.time_start, iden )
+        position = bisect_left( self._times, time_key )
+        if position < len( self._times ) and self._times[position] == time_key:
+            del self._times[position]
+    
+    @classmethod
+    def term_error( cls, category:str, search_term ) -> Exception:
+        """Return the TypeError or ValueError for an invalid search, or None"""
+        if not ( category in cls.CATEGORIES ):
+            return ValueError( "invalid search category: '{}'".format(category) )
+        if category == "status":
+            if not ( type(search_term) in ( str, int ) ):
+                return TypeError( "search term for 'status' not str or int: {!r}".format(search_term) )
+            if not ( ( search_term in cls.STATUSES ) or ( search_term in cls.STATUSES.values() ) ):
+                return ValueError( "invalid status: {0!r}, expected one of {1}".format( search_term, list( cls.STATUSES ) ) )
+            return None
+        if ( category == "time_start" ) and ( type(search_term) is tuple ):  # Inclusive (from, to) range
+            if not ( len(search_term) == 2 and all( type(time) is int for time in search_term ) ):
+                return TypeError( "search term for 'time_start' not a (from, to) pair of int: {!r}".format(search_term) )
+            return None
+        if not ( type(search_term) is cls.TERM_TYPES[category] ):
+            return TypeError( "search term for '{0}' not {1}: {2!r}".format( category, cls.TERM_TYPES[category].__name__, search_term ) )
+        return None
+    
+    def lookup( self, category:str, search_term ) -> set:
+        try:
+            error = self.term_error( category, search_term )
+            if error is not None:
+                raise error
+        except ( TypeError, ValueError ) as e:
+            report_error( "lookup", e )
+            raise  # Re-raise error for handling
+        if category == "name":
+            name_no = self._name_nos.get( search_term.lower() )
+            return set() if name_no is None else self._idens( self._name_idens[name_no] )
+        if category == "name_prefix":
+            prefix = search_term.lower()
+            found = set()
+            for name in self._sorted_names[ bisect_left( self._sorted_names, prefix ): ]:
+                if not name.startswith( prefix ):
+                    break
+                found |= self._idens( self._name_idens[ self._name_nos[name] ] )
+            return found
+        if category == "name_fuzzy":
+            grams = self.trigrams( search_term.lower() )
+            shared = Counter( name_no for gram in grams for name_no in self._trigrams.get( gram, () ) )
+            found = set()
+            for name_no, count in shared.items():
+                if count / len( grams | self.trigrams( self._names[name_no] ) ) >= self.fuzzy_threshold:  # Jaccard similarity
+                    found |= self._idens( self._name_idens[name_no] )
+            return found
+        if category == "telephone_no":
+            return self._idens( self._telephone_nos.get( search_term ) )
+        if category == "caravan_no":
+            return self._idens( self._caravan_nos.get( search_term ) )
+        if category == "time_start":  # HHMM, or inclusive (from, to) range
+            time_from, time_to = search_term if isinstance( search_term, tuple ) else ( search_term, search_term )
+            lo = bisect_left( self._times, self.__time_key( time_from, 0 ) )
+            hi = bisect_left( self._times, self.__time_key( time_to + 1, 0 ) )
+            mask = ( 1 << self.IDEN_BITS ) - 1
+            return { time_key & mask for time_key in self._times[lo:hi] }
+        return set()  # status is indexed by Transaction
+
+class MealLedger( TransactionListener ):
+    """Meal counts held column-wise (one column per meal key), for billing and revenue reports
+    
+    Per (service_date, status) column totals and per-slot covers are updated as parties
+    are added, change status or change meals, so a revenue figure is one dot product
+    of a totals row with the price row. A party's own counts are read from its shared
+    meal dict (see Transaction.shared_meals) rather than copied into a row.
+    """
+    def __init__( self, meals_config:dict ) -> None:
+        self.columns = OrderedDict()  # meal key: column
+        self.prices = array( "d" )
+        self._meals = {}  # iden: the party's meal dict
+        self._totals = {}  # (service_date, status): array of counts
+        self._slot_covers = {}  # service_date: {time_start: covers}, excluding cancelled parties
+        for meal_key, meal_details in meals_config.items():
+            self.__add_column( meal_key, meal_details["price"] )
+    
+    def __add_column( self, meal_key:str, price:float=0.0 ) -> int:
+        self.columns[meal_key] = len( self.prices )
+        self.prices.append( price )
+        for totals in self._totals.values():
+            totals.append(0)
+        return self.columns[meal_key]
+    
+    def __totals( self, service_date:date, status:int ) -> array:
+        key = ( service_date, status )
+        if key not in self._totals:
+            self._totals[key] = array( "l", [0] ) * len( self.prices )
+        return self._totals[key]
+    
+    def __add_slot_covers( self, service_date:date, time_start:int, covers:int ) -> None:
+        slots = self._slot_covers.setdefault( service_date, {} )
+        slots[time_start] = slots.get( time_start, 0 ) + covers
+    
+    ## Listener hooks (see Transaction.listeners)
+    
+    def party_added( self, iden:int, party:"Party" ) -> None:
+        self._meals[iden] = party.meals
+        self.meals_changed( party, party.meals )
+        if party.status != 2:
+            self.__add_slot_covers( party.service_date, party.time_start, party.covers )
+    
+    def status_changed( self, party:"Party", old_status:int, new_status:int ) -> None:
+        old_totals, new_totals = self.__totals( party.service_date, old_status ), self.__totals( party.service_date, new_status )
+        for meal_key, count in party.meals.items():
+            old_totals[ self.columns[meal_key] ] -= count
+            new_totals[ self.columns[meal_key] ] += count
+        if ( old_status == 2 ) != ( new_status == 2 ):
+            self.__add_slot_covers( party.service_date, party.time_start, party.covers if old_status == 2 else -party.covers )
+    
+    def meals_changed( self, party:"Party", meals_add:meals_data_typing ) -> None:
+        self._meals[ party.iden ] = party.meals
+        totals = self.__totals( party.service_date, party.status )
+        for meal_key, amount in meals_add.items():
+            column = self.columns[meal_key] if meal_key in self.columns else self.__add_column( meal_key )
+            totals[column] += amount
+    
+    def party_archived( self, iden:int, party:"Party" ) -> None:
+        """Forget the party; its counts stay in the totals"""
+        self._meals.pop( iden, None )
+    
+    ## Reports
+    
+    def dot( self, counts:array ) -> float:
+        return sum( count * price for count, price in zip( counts, self.prices ) )
+    
+    def bill( self, iden:int ) -> float:
+        """Total price of a party's meals"""
+        return round( sum( count * self.prices[ self.columns[meal_key] ] for meal_key, count in self._meals[iden].items() ), 2 )
+    
+    def meal_counts( self, date_from:date=None, date_to:date=None, statuses:Tuple[int, ...]=(0, 1) ) -> Dict[ str, int ]:
+        """Meals ordered per meal key over a period (inclusive, all dates by default)"""
+        counts = array( "l", [0] ) * len( self.prices )
+        for ( service_date, status ), totals in self._totals.items():
+            if ( status in statuses ) and ( date_from is None or service_date >= date_from ) and ( date_to is None or service_date <= date_to ):
+                for column, count in enumerate( totals ):
+                    counts[column] += count
+        return OrderedDict( ( meal_key, counts[column] ) for meal_key, column in self.columns.items() )
+    
+    def revenue( self, date_from:date=None, date_to:date=None, statuses:Tuple[int, ...]=(0, 1) ) -> float:
+        """Revenue over a period (inclusive, all dates by default), from pending and completed parties by default"""
+        return round( self.dot( array( "l", self.meal_counts( date_from, date_to, statuses ).values() ) ), 2 )
+    
+    def covers_by_slot( self, service_date:date ) -> "OrderedDict[int, int]":
+        """Covers arriving per start time on one evening, excluding cancelled parties"""
+        return OrderedDict( sorted( self._slot_covers.get( service_date, {} ).items() ) )
+
+class TimeAxis( object ):
+    """HHMM time <-> moment conversion for one service, built once as lookup tables
+    
+    Minutes roll over the hour and past midnight: a service closing at or before its
+    opening time (e.g. 1800 to 0130) is taken to close the next day.
+    """
+    def __init__( self, opening_time:int, closing_time:int, timing_interval_mins:int ) -> None:
+        self.opening_time = opening_time
+        self.closing_time = closing_time
+        self.timing_interval_mins = timing_interval_mins
+        self.open_mins = self.hhmm_to_mins( opening_time )
+        self.total_mins = self.hhmm_to_mins( closing_time ) - self.open_mins
+        if self.total_mins <= 0:
+            self.total_mins += 24 * 60  # Closes after midnight
+        self.moments = len( range( 0, self.total_mins, timing_interval_mins ) )
+        
+        ## Every valid time, closing time included when it falls on an interval
+        self.times = array( "l", ( self.mins_to_hhmm( self.open_mins + mins )
+                for mins in range( 0, self.total_mins + 1, timing_interval_mins ) ) )
+        self.moments_by_time = { time: moment for moment, time in enumerate( self.times ) }
+    
+    @staticmethod
+    def hhmm_to_mins( time:int ) -> int:
+        hour, mins = divmod( time, 100 )
+        return hour * 60 + mins
+    
+    @staticmethod
+    def mins_to_hhmm( mins:int ) -> int:
+        hour, mins = divmod( mins % ( 24 * 60 ), 60 )
+        return hour * 100 + mins
+    
+    def mins_from_opening( self, time:int ) -> int:
+        """Minutes from opening to an HHMM time, negative if before opening"""
+        mins = self.hhmm_to_mins( time ) - self.open_mins
+        if ( mins < 0 ) and ( mins + 24 * 60 <= self.total_mins ):
+            mins += 24 * 60  # After midnight
+        return mins
+    
+    def floor_moment( self, time:int ) -> int:
+        """Moment containing any HHMM time, which need not fall on an interval"""
+        return self.mins_from_opening( time ) // self.timing_interval_mins
+    
+    def time_to_moment( self, time:int ) -> int:
+        """Moment of a valid time, raising KeyError otherwise"""
+        return self.moments_by_time[time]
+    
+    def moment_to_time( self, moment:int ) -> int:
+        if 0 <= moment < len( self.times ):
+            return self.times[moment]
+        return self.mins_to_hhmm( self.open_mins + moment * self.timing_interval_mins )
+    
+    def times_to_moments( self, times:Iterable[int] ) -> array:
+        """Moments of many valid times at once, raising KeyError on the first invalid one"""
+        lookup = self.moments_by_time
+        return array( "l", [ lookup[time] for time in times ] )
+    
+    def moments_to_times( self, moments:Iterable[int] ) -> array:
+        return array( "l", [ self.moment_to_time( moment ) for moment in moments ] )
+
+class PrefixSums( object ):
+    """Counts per moment as a Fenwick tree: adding at a moment and summing a range are O(log moments)"""
+    def __init__( self, size:int ) -> None:
+        self.size = size
+        self._tree = array( "q", [0] ) * ( size + 1 )
+    
+    def add( self, moment:int, value:int ) -> None:
+        node = moment + 1
+        while node <= self.size:
+            self._tree[node] += value
+            node += node & -node
+    
+    def prefix( self, end:int ) -> int:
+        """Sum of moments 0..end-1"""
+        total, node = 0, end
+        while node > 0:
+            total += self._tree[node]
+            node -= node & -node
+        return total
+    
+    def between( self, start:int, end:int ) -> int:
+        """Sum of moments start..end-1"""
+        return self.prefix( end ) - self.prefix( start ) if end > start else 0
+
+class RangeAddMax( object ):
+    """Counts per moment as a segment tree under range additions, with the maximum at the root
+    
+    Each node holds the additions covering its whole range and the maximum below it, so
+    adding over a stay and reading one moment are O(log moments), and the peak value is O(1).
+    """
+    PADDING = -( 1 << 62 )  # Leaves past the last moment, so they never peak
+    
+    def __init__( self, size:int ) -> None:
+        self.size = size
+        self._leaves = leaves = 1 << max( size - 1, 0 ).bit_length()
+        self._added = array( "q", [0] ) * ( 2 * leaves )
+        self._best = array( "q", [0] ) * ( 2 * leaves )
+        for node in range( leaves + size, 2 * leaves ):
+            self._best[node] = self.PADDING
+        for node in range( leaves - 1, 0, -1 ):
+            self._best[node] = max( self._best[ 2 * node ], self._best[ 2 * node + 1 ] )
+    
+    def add( self, start:int, end:int, value:int ) -> None:
+        """Add value to moments start..end-1"""
+        self.__add( 1, 0, self._leaves, max( start, 0 ), min( end, self.size ), value )
+    
+    def __add( self, node:int, node_start:int, node_end:int, start:int, end:int, value:int ) -> None:
+        if ( end <= node_start ) or ( node_end <= start ):
+            return
+        if ( start <= node_start ) and ( node_end <= end ):
+            self._added[node] += value
+            self._best[node] += value
+            return
+        middle = ( node_start + node_end ) // 2
+        self.__add( 2 * node, node_start, middle, start, end, value )
+        self.__add( 2 * node + 1, middle, node_end, start, end, value )
+        self._best[node] = max( self._best[ 2 * node ], self._best[ 2 * node + 1 ] ) + self._added[node]
+    
+    def value_at( self, moment:int ) -> int:
+        total, node = 0, self._leaves + moment
+        while node:
+            total += self._added[node]
+            node //= 2
+        return total
+    
+    def peak( self ) -> Tuple[ int, int ]:
+        """(moment, value) of the first moment holding the maximum"""
+        if not self.size:
+            return 0, 0
+        node = 1
+        while node < self._leaves:
+            below = self._best[node] - self._added[node]
+            node = 2 * node if self._best[ 2 * node ] == below else 2 * node + 1
+        return node - self._leaves, self._best[1]
+
+class OccupancyAnalytics( TransactionListener ):
+    """Per-moment seated covers and free seats, per service date
+    
+    Driven by the tables actually booked and freed (see Restaurant), so unseated
+    bookings are left out and early departures count from when they leave. Seated
+    covers are a RangeAddMax and arrivals (covers at the moment they sit down,
+    cancelled parties left out) a PrefixSums, both updated in place on every change.
+    Per weekday arrival totals are kept alongside for demand curves.
+    """
+    def __init__( self, time_axis:TimeAxis, total_seats:int ) -> None:
+        self.time_axis = time_axis
+        self.moments = moments = time_axis.moments
+        self.total_seats = total_seats
+        self._covers = {}  # service_date: RangeAddMax
+        self._arrivals = {}  # service_date: PrefixSums
+        self._arrived = {}  # iden: moment its covers are counted in arrivals at
+        self._weekday_arrivals = [ array( "l", [0] ) * moments for _ in range(7) ]
+        self._weekday_dates = [ set() for _ in range(7) ]
+    
+    def moment( self, time:int ) -> int:
+        return self.time_axis.floor_moment( time )
+    
+    def __arrival( self, party:"Party", moment:int, sign:int ) -> None:
+        service_date = party.service_date
+        if service_date not in self._arrivals:
+            self._arrivals[service_date] = PrefixSums( self.moments )
+            self._weekday_dates[ service_date.weekday() ].add( service_date )
+        self._arrivals[service_date].add( moment, sign * party.covers )
+        self._weekday_arrivals[ service_date.weekday() ][moment] += sign * party.covers
+        if sign > 0:
+            self._arrived[ party.iden ] = moment
+        else:
+            self._arrived.pop( party.iden, None )
+    
+    ## Listener hooks (see Transaction.listeners)
+    
+    def seating_changed( self, party:"Party", start:int, end:int, sign:int ) -> None:
+        """A party was seated (sign 1) or left (sign -1) for moments start..end-1"""
+        if end <= start:
+            return
+        if party.service_date not in self._covers:
+            self._covers[party.service_date] = RangeAddMax( self.moments )
+        self._covers[party.service_date].add( start, end, sign * party.covers )
+        if ( sign > 0 ) and ( start == party.seat_moment ):
+            if party.iden in self._arrived:  # Seated again, e.g. once reactivated
+                self.__arrival( party, self._arrived[party.iden], -1 )
+            self.__arrival( party, start, 1 )
+    
+    def status_changed( self, party:"Party", old_status:int, new_status:int ) -> None:
+        if ( new_status == 2 ) and ( party.iden in self._arrived ):
+            self.__arrival( party, self._arrived[party.iden], -1 )
+    
+    def party_archived( self, iden:int, party:"Party" ) -> None:
+        self._arrived.pop( iden, None )  # Its covers stay counted
+    
+    ## Queries
+    
+    def covers_at( self, service_date:date, time:int ) -> int:
+        """Covers seated at a time"""
+        moment, covers = self.moment(time), self._covers.get( service_date )
+        return covers.value_at( moment ) if ( covers is not None ) and ( 0 <= moment < self.moments ) else 0
+    
+    def free_seats_at( self, service_date:date, time:int ) -> int:
+        return self.total_seats - self.covers_at( service_date, time )
+    
+    def arrivals_between( self, service_date:date, time_from:int, time_to:int ) -> int:
+        """Covers seated from time_from up to and including time_to"""
+        arrivals = self._arrivals.get( service_date )
+        if arrivals is None:
+            return 0
+        start = min( max( self.moment(time_from), 0 ), self.moments )
+        end = min( max( self.moment(time_to) + 1, 0 ), self.moments )
+        return arrivals.between( start, end )
+    
+    def peak( self, service_date:date ) -> Tuple[ int, int ]:
+        """(moment, covers) of the busiest moment of the evening"""
+        covers = self._covers.get( service_date )
+        return ( 0, 0 ) if covers is None else covers.peak()
+    
+    def demand_curve( self, weekday:int ) -> List[float]:
+        """Mean covers seated per moment on a weekday (0 is Monday), over every service date seen"""
+        days = len( self._weekday_dates[weekday] )
+        return [ total / days if days else 0.0 for total in self._weekday_arrivals[weekday] ]
+
+def arrival_order( party:"Party" ) -> tuple:
+    """Waitlist priority: first come, first seated"""
+    return ( party.time_start, party.iden )
+
+def largest_first( party:"Party" ) -> tuple:
+    """Waitlist priority: biggest parties first, then first come"""
+    return ( -party.covers, party.time_start, party.iden )
+
+class Waitlist( object ):
+    """Walk-ins waiting for a table, one heap per party size
+    
+    priority -- maps a party to its sort key, smallest first (arrival_order, largest_first or
+    any module-level function, so snapshots can pickle it); set it before anyone is waiting
+    Cancelled or seated parties are dropped lazily when they reach the head of their heap.
+    A party has at most one heap entry, so pushing someone already queued (or dropped but
+    not yet popped) only marks them as waiting.
+    """
+    def __init__( self, priority:Callable=arrival_order ) -> None:
+        self.priority = priority
+        self._heaps = {}  # covers: [(key, iden)]
+        self._waiting = {}  # iden: covers
+        self._queued = set()  # Idens with an entry in the heaps, waiting or not
+    
+    def __len__(self):
+        return len( self._waiting )
+    
+    def __contains__( self, iden ):
+        return iden in self._waiting
+    
+    def push( self, party:"Party" ) -> None:
+        if party.iden not in self._queued:
+            heappush( self._heaps.setdefault( party.covers, [] ), ( self.priority(party), party.iden ) )
+            self._queued.add( party.iden )
+        self._waiting[ party.iden ] = party.covers
+    
+    def discard( self, iden:int ) -> None:
+        self._waiting.pop( iden, None )
+    
+    def heads( self ) -> List[ Tuple[ tuple, int, int ] ]:
+        """(key, covers, iden) of the best waiting party of each size"""
+        heads = []
+        for covers, heap in list( self._heaps.items() ):
+            while heap and ( self._waiting.get( heap[0][1] ) != covers ):
+                self._queued.discard( heappop( heap )[1] )  # Stale entry
+            if heap:
+                heads.append( ( heap[0][0], covers, heap[0][1] ) )
+            else:
+                del self._heaps[covers]
+        return heads
 
 class Timetable( object ):
-    """Handle timetable operations"""
-    def __init__( self, opening_time:int, closing_time:int, timing_interval_mins:int, floors_and_tables_config:dict ):
+    """Handle timetable operations
+    
+    Occupancy is held per service date as one row per table, indexed by moment: an
+    array of party idens (-1 where free) plus an int bitset of the busy moments. A
+    date's rows are created by its first booking; service_date None is an undated grid.
+    """
+    ROW_TYPE = "i"  # Array type of the rows: 4 byte idens, up to 2 ** 31 - 1
+    
+    def __init__( self, opening_time:int, closing_time:int, timing_interval_mins:int, floors_and_tables_config:dict,
+            common_table_joins_config:dict=None, max_join_tables:int=3, join_cost:int=1 ):
         self.opening_time = opening_time
         self.closing_time = closing_time
         self.timing_interval_mins = timing_interval_mins
         self.floors_and_tables_config = floors_and_tables_config
-        
-        self._timetable = OrderedDict()
+        self.common_table_joins_config = common_table_joins_config or {}
+        self.max_join_tables = max_join_tables
+        self.join_cost = join_cost
         
         self._floors = OrderedDict()
         for floor_no, table_list in self.floors_and_tables_config.items():
             self._floors[floor_no] = Floor( table_list )
         
-        open_hour, open_min = divmod( self.opening_time, 100 )
-        close_hour, close_min = divmod( self.closing_time, 100 )
-        total_open_time_mins = ( close_hour - open_hour ) * 60  +  ( close_min - open_min )
-        for momentxinterval in range( 0, total_open_time_mins, self.timing_interval_mins ):
-            self._timetable[ int(momentxinterval/self.timing_interval_mins) ] = deepcopy(self._floors)
+        self.axis = TimeAxis( self.opening_time, self.closing_time, self.timing_interval_mins )
+        self.moments = self.axis.moments
+        
+        ## Occupancy per service date: (rows, busy bitsets), both keyed by (floor_no, table_no)
+        self._table_keys = [ (floor_no, table_no) for floor_no, floor in self._floors.items() for table_no in floor.tables ]
+        self._days = {}
+        self._idle = dict.fromkeys( self._table_keys, 0 )  # Busy bitsets of a date with no bookings
+        
+        ## Tables sorted by seat count, so queries skip tables that are too small
+        self._tables_by_seats = sorted(
+                ( floor.tables[table_no].seats, floor_no, table_no )
+                for floor_no, floor in self._floors.items() for table_no in floor.tables )
+        self._seat_counts = [ seats for seats, _, _ in self._tables_by_seats ]
+        
+        ## Joinable table groups as (floor_no, table_no) keys, sorted by seat count; allocations
+        ## hand out these key tuples, so seated parties share them rather than each holding copies
+        self._groups_by_seats = []
+        for floor_no, floor in self._floors.items():
+            for group in self.__table_groups( floor_no ):
+                seats = sum( floor.tables[table_no].seats for table_no in group )
+                self._groups_by_seats.append( ( seats, len(group), floor_no, tuple( (floor_no, table_no) for table_no in group ) ) )
+        self._groups_by_seats.sort( key=lambda g: g[:2] )  # Stable, so config order breaks ties
+        self._group_seat_counts = [ seats for seats, _, _, _ in self._groups_by_seats ]
     
-    def __str__(self):
-        ## Retrieve all floors
-        counter = 1  # Set to 1 to compensate for zero-indexing
-        to_return = bytearray("", "utf-8")  # Use bytearray
-        for key, item in self._floors.items():
-            to_add = "{}: [{}]".format(str(key), str(item))
-            to_return += bytearray(to_add, "utf-8")  # Append Floor
-            if not ( counter == len(self._floors) ):  # Only append comma and space if not end #not efficient
-                to_return += bytearray(", ", "utf-8")
-            counter += 1
-        to_return = to_return.decode(encoding='UTF-8')
-        all_floors = "{{{0}}}".format(to_return)
-        #return "{{{0}}}".format(to_return)  # Double curly brackets to escape
+    def __table_groups( self, floor_no:str ) -> List[ Tuple[ int, ... ] ]:
+        """Connected sets of up to max_join_tables tables on a floor, joined along common_table_joins_config
+        
+        Groups are grown one neighbouring table at a time, so the count is bounded by
+        tables * joins-per-table ** (max_join_tables - 1) rather than every subset of the floor.
+        """
+        tables = self._floors[floor_no].tables
+        neighbours = OrderedDict( ( table_no, [] ) for table_no in tables )
+        for join in self.common_table_joins_config.get( floor_no, [] ):
+            for table_no in join:
+                if table_no in neighbours:  # Ignore joins to tables that are not configured
+                    neighbours[table_no].extend( other for other in join if other != table_no and other in neighbours )
+        
+        level = [ (table_no,) for table_no in tables ]
+        groups = list( level )
+        seen = set( frozenset(group) for group in level )
+        for _ in range( 1, self.max_join_tables ):
+            next_level = []
+            for group in level:
+                for table_no in group:
+                    for other in neighbours[table_no]:
+                        grown = frozenset(group) | {other}
+                        if len(grown) > len(group) and grown not in seen:
+                            seen.add(grown)
+                            next_level.append( group + (other,) )
+            groups.extend( next_level )
+            level = next_level
+        return groups
+    
+    def __day( self, service_date:date ) -> Tuple[ "OrderedDict[Tuple[str, int], array]", Dict[ Tuple[str, int], int ] ]:
+        """Occupancy rows and busy bitsets of a service date, created empty on first use"""
+        day = self._days.get( service_date )
+        if day is None:
+            free_row = array( self.ROW_TYPE, [-1] ) * self.moments
+            day = self._days[service_date] = ( OrderedDict( ( key, array( self.ROW_TYPE, free_row ) ) for key in self._table_keys ),
+                    dict( self._idle ) )
+        return day
+    
+    def __busy( self, service_date:date ) -> Dict[ Tuple[str, int], int ]:
+        day = self._days.get( service_date )
+        return self._idle if day is None else day[1]
+    
+    def service_dates( self ) -> List[date]:
+        """Dates with occupancy rows, undated (None) first"""
+        return sorted( self._days, key=lambda service_date: ( service_date is not None, service_date ) )
+    
+    def clear( self, service_date:date ) -> None:
+        """Drop every booking on a service date"""
+        self._days.pop( service_date, None )
+    
+    def span( self, start_moment:int, length:int ) -> Tuple[ int, int ]:
+        """Return (start, end) moments of a stay, clipped to closing time"""
+        return max( start_moment, 0 ), min( start_moment + length, self.moments )
+    
+    @staticmethod
+    def span_mask( start:int, end:int ) -> int:
+        """Bitset with moments start..end-1 set"""
+        return ( ( 1 << ( end - start ) ) - 1 ) << start if end > start else 0
+    
+    def occupant( self, floor_no:str, table_no:int, moment:int, service_date:date=None ) -> int:
+        """Iden of the party at a table at a moment, or -1 if free"""
+        day = self._days.get( service_date )
+        if day is None:
+            return -1  # Nothing booked that day
+        return day[0][ (floor_no, table_no) ][moment]
+    
+    def is_free( self, floor_no:str, table_no:int, start_moment:int, length:int, service_date:date=None ) -> bool:
+        """Whether a table is free for the whole stay; an empty stay (at or after closing) never is"""
+        mask = self.span_mask( *self.span( start_moment, length ) )
+        return bool( mask ) and not ( self.__busy( service_date )[ (floor_no, table_no) ] & mask )
+    
+    def free_tables( self, covers:int, start_moment:int, length:int, service_date:date=None ) -> List[ Tuple[ str, int ] ]:
+        """Tables that seat covers and are free for the whole stay, smallest first
+        
+        Each table is tested with one AND of its busy bitset against the stay mask
+        (a range-max over the row), so no moment is scanned individually.
+        """
+        mask = self.span_mask( *self.span( start_moment, length ) )
+        if not mask:
+            return []  # Nothing can be seated at or after closing
+        busy = self.__busy( service_date )
+        return [ (floor_no, table_no)
+                for _, floor_no, table_no in self._tables_by_seats[ bisect_left( self._seat_counts, covers ): ]
+                if not ( busy[ (floor_no, table_no) ] & mask ) ]
+    
+    def allocate( self, covers:int, start_moment:int, length:int, service_date:date=None ) -> List[ Tuple[ str, int ] ]:
+        """Cheapest free table or joined group that seats covers for the whole stay, [] if none
+        
+        Cost is seats + join_cost per extra table, so candidates are walked in seat order and
+        the walk stops once the seat count alone exceeds the best cost found.
+        """
+        mask = self.span_mask( *self.span( start_moment, length ) )
+        if not mask:
+            return []  # Nothing can be seated at or after closing
+        busy = self.__busy( service_date )
+        best, best_cost = None, None
+        for seats, n_tables, floor_no, group in self._groups_by_seats[ bisect_left( self._group_seat_counts, covers ): ]:
+            if best_cost is not None and seats >= best_cost:
+                break
+            cost = seats + self.join_cost * ( n_tables - 1 )
+            if best_cost is not None and cost >= best_cost:
+                continue
+            if not any( busy[key] & mask for key in group ):
+                best, best_cost = list( group ), cost
+        return best or []
+    
+    def book( self, floor_no:str, table_no:int, start_moment:int, length:int, iden:int, service_date:date=None ) -> None:
+        """Mark a table as taken by party iden for length moments"""
+        key = (floor_no, table_no)
+        start, end = self.span( start_moment, length )
+        mask = self.span_mask( start, end )
+        rows, busy = self.__day( service_date )
+        try:
+            if busy[key] & mask:
+                raise ValueError( "table {1} on floor {0} is not free for moments {2} to {3}".format( floor_no, table_no, start, end ) )
+        except ValueError as e:
+            report_error( "book", e )
+            raise  # Re-raise error for handling
+        else:
+            rows[key][start:end] = array( self.ROW_TYPE, [iden] ) * ( end - start )  # Single slice assignment
+            busy[key] |= mask
+    
+    def release( self, floor_no:str, table_no:int, start_moment:int, length:int, service_date:date=None,
+            iden:int=None ) -> Tuple[ int, int ]:
+        """Free a table for length moments, or only those of them held by party iden
+        Return the (start, end) moments freed, which are empty (start == end) if none were.
+        """
+        day = self._days.get( service_date )
+        start, end = self.span( start_moment, length )
+        if day is None:
+            return start, start  # Nothing booked that day
+        rows, busy = day
+        key, row = (floor_no, table_no), day[0][ (floor_no, table_no) ]
+        if iden is None:
+            row[start:end] = array( self.ROW_TYPE, [-1] ) * ( end - start )
+            busy[key] &= ~self.span_mask( start, end )
+            return start, end
+        held = [ moment for moment in range( start, end ) if row[moment] == iden ]
+        for moment in held:
+            row[moment] = -1
+            busy[key] &= ~( 1 << moment )
+        return ( held[0], held[-1] + 1 ) if held else ( start, start )
+    
+    def held_tables( self, iden:int, service_date:date=None ) -> List[ Tuple[ str, int ] ]:
+        """Tables holding party iden at any moment of a service date"""
+        day = self._days.get( service_date )
+        return [] if day is None else [ key for key, row in day[0].items() if iden in row ]
+    
+    def iter_str( self ) -> Iterator[str]:
+        """Yield the printed timetable piece by piece"""
+        all_floors = "{{{0}}}".format( ", ".join(
+                "{}: [{}]".format( str(key), str(item) ) for key, item in self._floors.items() ) )  # Double curly brackets to escape
         
         ## Put all floors into each time in timetable
-        counter = 1  # Set to 1 to compensate for zero-indexing
-        to_return = bytearray("", "utf-8")  # Use bytearray
-        for key, item in self._timetable.items():
-            to_add = "{}: [{}]".format(str(key), all_floors)
-            to_return += bytearray(to_add, "utf-8")  # Append Floors
-            if not ( counter == len(self._timetable) ):  # Only append comma and space if not end #not efficient
-                to_return += bytearray(", ", "utf-8")
-            counter += 1
-        to_return = to_return.decode(encoding='UTF-8')
-        timetable_print = "{{{0}}}".format(to_return)
-        return timetable_print
+        yield "{"
+        for key in range( self.moments ):
+            if key:
+                yield ", "
+            yield "{}: [{}]".format( str(key), all_floors )
+        yield "}"
+    
+    def __str__(self):
+        return "".join( self.iter_str() )
+    
+    CSV_FIELDS = [ "moment", "floor", "table", "seats", "iden" ]
+    
+    def iter_rows( self, service_date:date=None ) -> Iterator[dict]:
+        """One row per table per moment of a service date, -1 iden where free"""
+        seats = { (floor_no, table_no): table.seats
+                for floor_no, floor in self._floors.items() for table_no, table in floor.tables.items() }
+        day = self._days.get( service_date )
+        free_row = array( self.ROW_TYPE, [-1] ) * self.moments
+        rows = list( day[0].items() ) if day is not None else [ ( key, free_row ) for key in self._table_keys ]
+        for moment in range( self.moments ):
+            for ( floor_no, table_no ), row in rows:
+                yield { "moment": moment, "floor": floor_no, "table": table_no,
+                        "seats": seats[ (floor_no, table_no) ], "iden": row[moment] }
+    
+    def iter_floor_rows( self ) -> Iterator[dict]:
+        for floor_no, floor in self._floors.items():
+            for row in floor.iter_rows():
+                yield dict( row, floor=floor_no )
+    
+    def iter_jsonl( self, service_date:date=None ) -> Iterator[str]:
+        return iter_jsonl( self.iter_rows( service_date ) )
+    
+    def iter_csv( self, service_date:date=None ) -> Iterator[str]:
+        return iter_csv( self.iter_rows( service_date ), self.CSV_FIELDS )
     
     def __repr__(self):
         pass
 
 class Restaurant( object ):
     
-    def __init__( self, *args ) -> None:
-        """Initiate restaurant object with config_files (args)"""
+    CONFIG_ATTRIBUTES = ( "timing_interval_mins", "restaurant_name", "opening_time", "final_orders", "closing_time",
+            "max_stay", "floors_and_tables_config", "common_table_joins_config", "meals" )
+    
+    def __init__( self, *args, journal_dir:Path=None, archive_dir:Path=None, config_cache:bool=True, service_date:date=None,
+            waitlist_priority:Callable=arrival_order ) -> None:
+        """Initiate restaurant object with config_files (args)
+        journal_dir -- if given, mutations are journalled there and state is restored from it
+        archive_dir -- if given, close_service() moves finished parties to a columnar archive there
+        config_cache -- reuse the validated config compiled by an earlier start, if the files are unchanged
+        service_date -- the evening new parties are booked for, today by default
+        waitlist_priority -- order walk-ins are offered freed tables in (see Waitlist), first come by default
+        """
+        
+        self.journal = None
+        self.archive = None
+        self._replaying = False
+        self.service_date = service_date or date.today()
         
         self.timing_interval_mins = 1
         
@@ -169,78 +1221,176 @@ class Restaurant( object ):
         
         self.meals = {}
         
-        for config_file in args:
-            with config_file.open() as f:
-                exec( f.read() )
+        cache_path = self.config_cache_path( *args ) if ( config_cache and args ) else None
+        cache_key = self.config_cache_key( *args ) if ( cache_path is not None ) else None
+        cached = None
+        if ( cache_path is not None ) and cache_path.exists():
+            try:
+                with cache_path.open("rb") as f:
+                    cached_key, cached = pickle.load( f )
+                if not ( isinstance( cached, dict ) and set( cached ) == set( self.CONFIG_ATTRIBUTES ) ):
+                    raise ValueError( "config cache {} does not hold {}".format( cache_path, self.CONFIG_ATTRIBUTES ) )
+            except Exception as e:
+                report_error( "__init__", e, "recompiling config" )
+                cached = None  # Unreadable cache, recompile
+            else:
+                if cached_key != cache_key:
+                    cached = None  # Config or validator changed since, recompile
+        
+        if cached is not None:
+            self.__dict__.update( cached )
+        else:
+            for config_file in args:
+                with config_file.open() as f:
+                    exec( f.read() )
         
         try:
-            ## Main configs
-            if not (type(self.timing_interval_mins) is int):
-                raise TypeError("self.timing_interval_mins is not int")
-            
-            if not (type(self.restaurant_name) is str):
-                raise TypeError("self.restaurant_name is not str")
-            
-            for times in (self.opening_time, self.final_orders, self.closing_time):
-                if not (type(times) is int):
-                    raise TypeError("'{}' not integer".format(times))
-            
-            if not (type(self.floors_and_tables_config) is dict):
-                if not (type(self.floors_and_tables_config) is OrderedDict):
-                    raise TypeError("self.floors_and_tables is not dict")
-            for floor_key in self.floors_and_tables_config.keys():  # Check valid floor and table config format
-                if not (type( self.floors_and_tables_config[floor_key] ) is list):
-                    raise TypeError("floor index {0} is not a list".format( floor_key ))
-                for table_key, table in enumerate( self.floors_and_tables_config[floor_key] ):
-                    kt = frozenset((floor_key, table_key))
-                    for to_check, type_, error_message in zip(
-                            [type(table), len(table), type(table[0]), type(table[1]),],
-                            [list, 2, int, int,],
-                            ["floor index '{1}', table index '{0}': is not a list".format(*kt),
-                            "floor index '{1}', table index '{0}': list length not 2".format(*kt),
-                            "floor index '{1}', table index '{0}': table number (index 0) not int".format(*kt),
-                            "floor index '{1}', table index '{0}': seat count (index 0) not int".format(*kt),
-                            ] ):
-                        if not (to_check is type_):
-                            raise TypeError(error_message)
-            
-            if not (type(self.common_table_joins_config) is dict):
-                if not (type(self.common_table_joins_config) is OrderedDict):
-                    raise TypeError("self.common_table_joins is not dict")
-                
-            ## Meals
-            if not (type(self.meals) is dict):
-                raise TypeError("self.meals is not dict")
-            for meal_key, meal_details in self.meals.items():
-                if not (type(meal_key) is str):
-                    raise TypeError("meal key {0} not str".format( meal_key ))
-                if not (type(meal_details) is dict):
-                    raise TypeError("meal key '{0}': details not dict".format( meal_key ))
-                for i in ( "name", "price", "veg", "egg_free", "dairy_free", "nut_free" ):
-                    if not (i in meal_details):
-                        raise TypeError("meal key '{0}': does not specify {1}".format( meal_key, i ))
-                
-                if not (type(meal_details["name"]) is str):
-                    raise TypeError("meal key '{0}', detail key '{1}': {2} is not str".format( meal_key, "name", meal_details["name"] ))
-                if not (type(meal_details["price"]) is float):
-                    raise TypeError("meal key '{0}', detail key '{1}': {2} is not int".format( meal_key, "price", meal_details["price"] ))
-                if not (meal_details["veg"] in ( 0, 1, 2, None )):
-                    raise TypeError("meal key '{0}', detail key '{1}': {2} not in ( 0, 1, 2, None )".format( meal_key, "veg", meal_details["veg"] ))
-                if not (meal_details["egg_free"] in ( True, False, None )):
-                    raise TypeError("meal key '{0}', detail key '{1}': {2} is not bool or None".format( meal_key, "egg_free", meal_details["egg_free"] ))
-                if not (meal_details["dairy_free"] in ( True, False, None )):
-                    raise TypeError("meal key '{0}', detail key '{1}': {2} is not bool or None".format( meal_key, "dairy_free", meal_details["dairy_free"] ))
-                if not (meal_details["nut_free"] in ( True, False, None )):
-                    raise TypeError("meal key '{0}', detail key '{1}': {2} is not bool or None".format( meal_key, "nut_free", meal_details["nut_free"] ))
-            
+            if cached is None:
+                self.__validate_config()
         except TypeError as e:
-            print( "Error in {0}: {1}".format( sys._getframe().f_code.co_name, e.args ) )
+            report_error( "__init__", e )
             raise  # Re-raise error for handling
         
         else:
+            if ( cached is None ) and ( cache_path is not None ):
+                self.__write_config_cache( cache_path, cache_key )
+            self.stay_moments = -( -self.max_stay // self.timing_interval_mins )  # Round up
             self.transactions = Transaction()
+            self.ledger = MealLedger( self.meals )
+            self.transactions.listeners.append( self.ledger )
             self.timetable = Timetable( opening_time=self.opening_time, closing_time=self.closing_time, timing_interval_mins=self.timing_interval_mins, 
-            floors_and_tables_config=self.floors_and_tables_config)
+            floors_and_tables_config=self.floors_and_tables_config, common_table_joins_config=self.common_table_joins_config)
+            self.time_axis = self.timetable.axis
+            self.analytics = OccupancyAnalytics( time_axis=self.time_axis, total_seats=sum( self.timetable._seat_counts ) )
+            self.transactions.listeners.append( self.analytics )
+            self.meal_index = MealIndex( self.meals )
+            self.dietary = DietaryRollup( self.meal_index, self.time_axis )
+            self.transactions.listeners.append( self.dietary )
+            self.waitlist = Waitlist( waitlist_priority )
+            self.archive = None if archive_dir is None else Archive( archive_dir )
+            self.transactions.archive = self.archive
+            if journal_dir is not None:
+                self.journal = Journal( journal_dir )
+                self.__restore()
+            if self.archive is not None:
+                self.transactions.reserve_idens( self.archive.next_iden )  # After any replay, which reuses the journalled idens
+    
+    def __validate_config( self ) -> None:
+        """Type check the exec'd config, raising TypeError on the first problem"""
+        ## Main configs
+        if not (type(self.timing_interval_mins) is int):
+            raise TypeError("self.timing_interval_mins is not int")
+        
+        if not (type(self.restaurant_name) is str):
+            raise TypeError("self.restaurant_name is not str")
+        
+        for times in (self.opening_time, self.final_orders, self.closing_time):
+            if not (type(times) is int):
+                raise TypeError("'{}' not integer".format(times))
+        
+        if not (type(self.floors_and_tables_config) is dict):
+            if not (type(self.floors_and_tables_config) is OrderedDict):
+                raise TypeError("self.floors_and_tables is not dict")
+        for floor_key in self.floors_and_tables_config.keys():  # Check valid floor and table config format
+            if not (type( self.floors_and_tables_config[floor_key] ) is list):
+                raise TypeError("floor index {0} is not a list".format( floor_key ))
+            for table_key, table in enumerate( self.floors_and_tables_config[floor_key] ):
+                kt = frozenset((floor_key, table_key))
+                for to_check, type_, error_message in zip(
+                        [type(table), len(table), type(table[0]), type(table[1]),],
+                        [list, 2, int, int,],
+                        ["floor index '{1}', table index '{0}': is not a list".format(*kt),
+                        "floor index '{1}', table index '{0}': list length not 2".format(*kt),
+                        "floor index '{1}', table index '{0}': table number (index 0) not int".format(*kt),
+                        "floor index '{1}', table index '{0}': seat count (index 0) not int".format(*kt),
+                        ] ):
+                    if not (to_check is type_):
+                        raise TypeError(error_message)
+        
+        if not (type(self.common_table_joins_config) is dict):
+            if not (type(self.common_table_joins_config) is OrderedDict):
+                raise TypeError("self.common_table_joins is not dict")
+        for floor_key, joins in self.common_table_joins_config.items():
+            if not (type(joins) is list):
+                raise TypeError("joins for floor index {0} is not a list".format( floor_key ))
+            for join in joins:
+                if not ( type(join) is list and all( type(table_no) is int for table_no in join ) ):
+                    raise TypeError("floor index '{0}': join {1} is not a list of table numbers".format( floor_key, join ))
+            
+        ## Meals
+        if not (type(self.meals) is dict):
+            raise TypeError("self.meals is not dict")
+        for meal_key, meal_details in self.meals.items():
+            if not (type(meal_key) is str):
+                raise TypeError("meal key {0} not str".format( meal_key ))
+            if not (type(meal_details) is dict):
+                raise TypeError("meal key '{0}': details not dict".format( meal_key ))
+            for i in ( "name", "price", "veg", "egg_free", "dairy_free", "nut_free" ):
+                if not (i in meal_details):
+                    raise TypeError("meal key '{0}': does not specify {1}".format( meal_key, i ))
+            
+            if not (type(meal_details["name"]) is str):
+                raise TypeError("meal key '{0}', detail key '{1}': {2} is not str".format( meal_key, "name", meal_details["name"] ))
+            if not (type(meal_details["price"]) is float):
+                raise TypeError("meal key '{0}', detail key '{1}': {2} is not int".format( meal_key, "price", meal_details["price"] ))
+            if not (meal_details["veg"] in VEG_LEVELS + ( None, )):
+                raise TypeError("meal key '{0}', detail key '{1}': {2} not in {3}".format( meal_key, "veg", meal_details["veg"], VEG_LEVELS + ( None, ) ))
+            if not (meal_details["egg_free"] in ( True, False, None )):
+                raise TypeError("meal key '{0}', detail key '{1}': {2} is not bool or None".format( meal_key, "egg_free", meal_details["egg_free"] ))
+            if not (meal_details["dairy_free"] in ( True, False, None )):
+                raise TypeError("meal key '{0}', detail key '{1}': {2} is not bool or None".format( meal_key, "dairy_free", meal_details["dairy_free"] ))
+            if not (meal_details["nut_free"] in ( True, False, None )):
+                raise TypeError("meal key '{0}', detail key '{1}': {2} is not bool or None".format( meal_key, "nut_free", meal_details["nut_free"] ))
+    
+    CONFIG_CACHE_VERSION = 2  # Bump whenever __validate_config() or CONFIG_ATTRIBUTES change, so older caches are recompiled
+    CONFIG_CACHE_PROTOCOL = 4  # Fixed, so the cache never depends on which Python wrote it
+    
+    @classmethod
+    def config_cache_path( cls, *config_files:Path ) -> Path:
+        """Cache file for a set of config files, named after them, so each set has one file that is overwritten on change"""
+        names = hashlib.sha1( "\0".join( config_file.name for config_file in config_files ).encode("utf-8") ).hexdigest()
+        return config_files[0].parent / "__pycache__" / "restam_config.{}.pickle".format( names[:16] )
+    
+    @classmethod
+    def config_cache_key( cls, *config_files:Path ) -> str:
+        """Digest of CONFIG_CACHE_VERSION and the config files' text; a cache stored under any other key is stale"""
+        digest = hashlib.sha1( str( cls.CONFIG_CACHE_VERSION ).encode("utf-8") + b"\0" )
+        for config_file in config_files:
+            digest.update( config_file.name.encode("utf-8") + b"\0" + config_file.read_bytes() + b"\0" )
+        return digest.hexdigest()
+    
+    def __write_config_cache( self, cache_path:Path, cache_key:str ) -> None:
+        config = { attribute: getattr( self, attribute ) for attribute in self.CONFIG_ATTRIBUTES }
+        try:
+            cache_path.parent.mkdir( exist_ok=True )
+            tmp_path = cache_path.with_suffix(".tmp")
+            with tmp_path.open("wb") as f:
+                pickle.dump( ( cache_key, config ), f, self.CONFIG_CACHE_PROTOCOL )
+            os.replace( str(tmp_path), str(cache_path) )
+        except OSError:
+            pass  # Read-only install, compile again next start
+    
+    def __restore( self ) -> None:
+        """Load the latest snapshot and replay the journal tail after it"""
+        state, records = self.journal.load()
+        if state is not None:
+            self.__dict__.update( state )
+            self.time_axis = self.timetable.axis
+            self.transactions.archive = self.archive
+        service_date = self.service_date
+        self._replaying = True
+        try:
+            for method, args, kwargs, self.service_date in records:
+                getattr( self, method )( *args, **kwargs )
+        finally:
+            self._replaying = False
+            self.service_date = service_date
+    
+    SNAPSHOT_ATTRIBUTES = ( "transactions", "timetable", "ledger", "analytics", "dietary", "waitlist" )
+    
+    def snapshot( self ) -> None:
+        """Write a snapshot of the restaurant state, bounding journal replay"""
+        self.journal.snapshot( { attribute: getattr( self, attribute ) for attribute in self.SNAPSHOT_ATTRIBUTES } )
     
     def __str__(self):
         pass
@@ -248,63 +1398,269 @@ class Restaurant( object ):
     def __repr__(self):
         pass
     
+    def __time_error( self, time ) -> ValueError:
+        """Return the ValueError for an invalid time, or None"""
+        if time in self.time_axis.moments_by_time:
+            return None
+        if not ( 0 <= self.time_axis.mins_from_opening( time ) <= self.time_axis.total_mins ):
+            return ValueError( "time ({2}) not between opening times: {0} and {1}".format( self.opening_time, self.closing_time, time ) )
+        return ValueError( "time ({2}) is not at an interval of {0} mins from opening time ({1})".format( self.timing_interval_mins, self.opening_time, time ) )
+    
+    @instrumented
     def time_to_moment( self, time ):
         try:
-            if not ( ( time >= self.opening_time ) and ( time <= self.closing_time ) ):
-                raise ValueError( "time ({2}) not between opening times: {0} and {1}".format( self.opening_time, self.closing_time, time ) )
-            if not ( ( time - self.opening_time ) % self.timing_interval_mins == 0 ):
-                raise ValueError( "time ({2}) is not at an interval of {0} mins from opening time ({1})".format( self.timing_interval_mins, self.opening_time, time ) )
-        except ValueError as e:
-            print( "Error in {0}: {1}".format( sys._getframe().f_code.co_name, e.args ) )
-            raise # Re-raise error for handling
-        else:
-            open_hour, open_min = divmod( self.opening_time, 100 )
-            time_hour, time_min = divmod( time, 100 )
-            return int(  ( ( time_hour - open_hour ) * 60  +  ( time_min - open_min ) ) / self.timing_interval_mins  )
+            return self.time_axis.moments_by_time[time]
+        except KeyError:
+            error = self.__time_error( time )
+            report_error( "time_to_moment", error )
+            raise error from None  # Raise for handling
     
+    @instrumented
     def moment_to_time( self, moment ):
-        hour_add, min_add = divmod( moment * self.timing_interval_mins, 60 )
-        to_add = hour_add * 100 + min_add
-        return int( self.opening_time + to_add )
+        return self.time_axis.moment_to_time( moment )
+    
+    @instrumented
+    def times_to_moments( self, times:Iterable[int] ) -> array:
+        """Convert many HHMM times at once, e.g. for imports and reports"""
+        try:
+            return self.time_axis.times_to_moments( times )
+        except KeyError as e:
+            error = self.__time_error( e.args[0] )
+            report_error( "times_to_moments", error )
+            raise error from None  # Raise for handling
+    
+    @instrumented
+    def moments_to_times( self, moments:Iterable[int] ) -> array:
+        return self.time_axis.moments_to_times( moments )
     
+    @instrumented
+    @journalled
     def add_party( self, time_start:int, meals:dict, booked:bool,
-            name:str="anon", caravan_no:int=-1, telephone_no:int=-1, additional_notes:str="" ) -> "Restaurant":
-        time_length = self.max_stay  # Need error check in init
+            name:str="anon", caravan_no:int=-1, telephone_no:int=-1, additional_notes:str="", covers:int=None ) -> "Restaurant":
         try:
-            if not (type(meals) is dict):
-                raise TypeError("meals is not dict")
+            errors = self.__party_errors( time_start=time_start, meals=meals, booked=booked, name=name,
+                    caravan_no=caravan_no, telephone_no=telephone_no, additional_notes=additional_notes, covers=covers )
+            if errors:
+                raise errors[0]
+        except ( TypeError, ValueError ) as e:
+            report_error( "add_party", e )
+            raise  # Re-raise error for handling
+        else:
+            party_add = self.__make_party( time_start=time_start, meals=meals, booked=booked, name=name,
+                    caravan_no=caravan_no, telephone_no=telephone_no, additional_notes=additional_notes, covers=covers )
+            iden = self.transactions.add( party_add )
+            if not ( self.__add_party_to_timetable( iden=iden ) or booked ):
+                self.waitlist.push( party_add )  # Walk-in with no free table
+    
+    def __party_errors( self, time_start:int, meals:dict, booked:bool,
+            name:str="anon", caravan_no:int=-1, telephone_no:int=-1, additional_notes:str="", covers:int=None ) -> List[Exception]:
+        """Every problem with a set of add_party arguments"""
+        errors = []
+        if not (type(meals) is dict):
+            errors.append( TypeError("meals is not dict") )
+        else:
             for key, value in meals.items():
                 if not (type(key) is str):
-                    raise TypeError("meals key '{0}' not str".format( key ))
+                    errors.append( TypeError("meals key '{0}' not str".format( key )) )
                 if not (type(value) is int):
-                    raise TypeError("meals key '{0}': value not int".format( key ))
-            
-            if not (type(booked) is bool):
-                raise TypeError("booked not int")
-            if not (type(name) is str):
-                raise TypeError("name not str")
-            if not (type(caravan_no) is int):
-                raise TypeError("caravan_no not int")
-            if not (type(telephone_no) is int):
-                raise TypeError("telephone_no not int")
-            if not (type(additional_notes) is str):
-                raise TypeError("additional_notes not str")
-        except TypeError as e:
-            print( "Error in {}".format(sys._getframe().f_code.co_name), e.args )
-            raise  # Re-raise error for handling
+                    errors.append( TypeError("meals key '{0}': value not int".format( key )) )
+        
+        if not (type(booked) is bool):
+            errors.append( TypeError("booked not int") )
+        if not (type(name) is str):
+            errors.append( TypeError("name not str") )
+        if not (type(caravan_no) is int):
+            errors.append( TypeError("caravan_no not int") )
+        if not (type(telephone_no) is int):
+            errors.append( TypeError("telephone_no not int") )
+        if not (type(additional_notes) is str):
+            errors.append( TypeError("additional_notes not str") )
+        if not ( covers is None or type(covers) is int ):
+            errors.append( TypeError("covers not int") )
+        if not (type(time_start) is int):
+            errors.append( TypeError("time_start not int") )
         else:
-            party_add = Party( time_start=time_start, time_length=time_length,
-                    meals=meals, booked=booked, name=name,
-                    caravan_no=caravan_no, telephone_no=telephone_no, additional_notes=additional_notes )
-            self.transactions.add( party_add )
+            time_error = self.__time_error( time_start )
+            if time_error is not None:
+                errors.append( time_error )
+            elif self.time_axis.time_to_moment( time_start ) >= self.time_axis.moments:
+                errors.append( ValueError( "time_start ({0}) is not before closing time ({1})".format( time_start, self.closing_time ) ) )
+            elif self.time_axis.mins_from_opening( time_start ) > self.time_axis.mins_from_opening( self.final_orders ):
+                errors.append( ValueError( "time_start ({0}) is after final orders ({1})".format( time_start, self.final_orders ) ) )
+        return errors
     
-    def __add_party_to_timetable( self, iden:str ) -> bool: # move to own class
-        pass
-        #start_moment = self.time_to_moment( self.transactions.get(iden).time_start )
-        #start_timeframe = self.timetable[start_moment]
-        #self.timetable.get(start_moment) = self.transactions[iden] #testing
+    def __make_party( self, time_start:int, meals:dict, booked:bool,
+            name:str="anon", caravan_no:int=-1, telephone_no:int=-1, additional_notes:str="", covers:int=None ) -> "Party":
+        time_length = self.max_stay  # Need error check in init
+        if covers is None:
+            covers = sum( meals.values() )
+        return Party( time_start=time_start, time_length=time_length,
+                meals=meals, booked=booked, name=name,
+                caravan_no=caravan_no, telephone_no=telephone_no, additional_notes=additional_notes, covers=covers,
+                service_date=self.service_date )
+    
+    @instrumented
+    @journalled
+    def add_parties( self, parties:List[ Dict[ str, Any ] ], require_seating:bool=True ) -> List[int]:
+        """Add a batch of parties (each a dict of add_party arguments) all at once, or none at all
+        parties -- the batch, validated in a single pass; every problem is reported in one BatchError
+        require_seating -- reject the whole batch if any party cannot be given a table
+        Return the idens given to the parties, in batch order.
+        """
+        required = ( "time_start", "meals", "booked" )
+        optional = ( "name", "caravan_no", "telephone_no", "additional_notes", "covers" )
+        errors = []
+        for index, kwargs in enumerate( parties ):
+            if not isinstance( kwargs, dict ):
+                errors.append( ( index, TypeError("party is not dict") ) )
+                continue
+            missing = [ key for key in required if key not in kwargs ]
+            unknown = [ key for key in kwargs if key not in required + optional ]
+            if missing or unknown:
+                errors.append( ( index, TypeError("missing arguments {0}, unknown arguments {1}".format( missing, unknown )) ) )
+                continue
+            errors.extend( ( index, error ) for error in self.__party_errors( **kwargs ) )
+        try:
+            if errors:
+                raise BatchError( "{0} problem(s) in batch of {1}".format( len(errors), len(parties) ), errors )
+        except BatchError as e:
+            report_error( "add_parties", e )
+            for index, error in e.errors:
+                report_error( "add_parties", error, "party {}".format(index) )
+            raise  # Re-raise error for handling
+        
+        ## Reserve tables under the idens the parties will get, largest parties first
+        first_iden = self.transactions.next_iden
+        new_parties = [ self.__make_party( **kwargs ) for kwargs in parties ]
+        booked = []  # (floor_no, table_no, start_moment, service_date)
+        allocations = {}
+        try:
+            for offset in sorted( range( len(new_parties) ), key=lambda i: ( -new_parties[i].covers, new_parties[i].time_start ) ):
+                party = new_parties[offset]
+                start_moment = self.time_to_moment( party.time_start )
+                tables = self.timetable.allocate( party.covers, start_moment, self.stay_moments, party.service_date )
+                if not tables:
+                    if require_seating:
+                        raise BatchError( "no free table for party {0} ({1} covers at {2})".format( offset, party.covers, party.time_start ),
+                                [ ( offset, ValueError("no free table") ) ] )
+                    continue
+                for floor_no, table_no in tables:
+                    self.timetable.book( floor_no, table_no, start_moment, self.stay_moments, first_iden + offset, party.service_date )
+                    booked.append( ( floor_no, table_no, start_moment, party.service_date ) )
+                allocations[offset] = ( tuple(tables), start_moment )
+        except Exception as e:
+            for floor_no, table_no, start_moment, service_date in booked:  # Roll back every reservation
+                self.timetable.release( floor_no, table_no, start_moment, self.stay_moments, service_date )
+            report_error( "add_parties", e )
+            raise  # Re-raise error for handling
+        
+        idens = []
+        for offset, party in enumerate( new_parties ):
+            party.tables, party.seat_moment = allocations.get( offset, ( (), None ) )
+            idens.append( self.transactions.add( party ) )
+            if party.tables:
+                self.transactions.seating_changed( party, *self.timetable.span( party.seat_moment, self.stay_moments ), 1 )
+            if not ( party.tables or party.booked ):
+                self.waitlist.push( party )
+        return idens
+    
+    @instrumented
+    def find_free_tables( self, time_start:int, covers:int, service_date:date=None ) -> List[ Tuple[ str, int ] ]:
+        """Tables (floor_no, table_no) that can seat covers from time_start for max_stay, smallest first
+        service_date -- the evening to look at, the current one by default
+        """
+        return self.timetable.free_tables( covers, self.time_to_moment( time_start ), self.stay_moments,
+                self.service_date if service_date is None else service_date )
+    
+    def __add_party_to_timetable( self, iden:int, start_moment:int=None, last_moment:int=None ) -> bool:
+        """Seat a party at the cheapest free table or join that fits, return False if none is free
+        start_moment -- when they sit down, if later than their time_start
+        last_moment -- if nothing is free at start_moment, seat them at the first moment up to this one that is
+        """
+        party = self.transactions.get(iden)
+        if start_moment is None:
+            start_moment = self.time_to_moment( party.time_start )
+        if last_moment is None:
+            last_moment = start_moment
+        tables = []
+        while not tables and start_moment <= last_moment:
+            tables = self.timetable.allocate( party.covers, start_moment, self.stay_moments, party.service_date )
+            start_moment += 0 if tables else 1
+        if not tables:
+            return False
+        for floor_no, table_no in tables:
+            self.timetable.book( floor_no, table_no, start_moment, self.stay_moments, iden, party.service_date )
+        party.tables = tuple( tables )
+        party.seat_moment = start_moment
+        self.transactions.seating_changed( party, *self.timetable.span( start_moment, self.stay_moments ), 1 )
+        self.waitlist.discard( iden )
+        return True
     
+    def __release_tables( self, iden:int, time:int=None ) -> None:
+        """Free a party's tables from time (or for their whole stay), then seat whoever is waiting
+        
+        Only moments still held by the party are freed, so a table since given to someone
+        else is left alone. The party no longer holds any table afterwards.
+        """
+        party = self.transactions.get(iden)
+        if not party.tables:
+            return
+        release_moment = party.seat_moment
+        if time is not None:
+            release_moment = max( release_moment, self.time_to_moment( time ) )
+        self.__free_held( party, party.tables, release_moment, self.stay_moments )
+        party.tables, party.seat_moment = (), None
+        self.__seat_waiting( release_moment, None if time is None else release_moment )
+    
+    def __free_held( self, party:"Party", tables:Iterable[ Tuple[ str, int ] ], start_moment:int, length:int ) -> None:
+        """Free the moments a party holds on tables from start_moment for length moments
+        
+        Joined tables are freed together, so the departure is reported to listeners once,
+        over the moments freed on any of them, rather than once per table.
+        """
+        freed = None
+        for floor_no, table_no in tables:
+            start, end = self.timetable.release( floor_no, table_no, start_moment, length, party.service_date, iden=party.iden )
+            if end > start:
+                freed = ( start, end ) if freed is None else ( min( freed[0], start ), max( freed[1], end ) )
+        if freed is not None:
+            self.transactions.seating_changed( party, *freed, -1 )
+    
+    def __seat_waiting( self, release_moment:int, now:int=None ) -> None:
+        """Seat the best waiting parties that now fit, each at the first moment a table is free for them,
+        from their arrival (or from now, if later) up to release_moment, when the freed tables open up
+        
+        Only the head of each party-size queue is tried, best first, so a release costs
+        O(party sizes waiting) allocations rather than a pass over the whole waitlist.
+        """
+        seated = True
+        while seated and self.waitlist:
+            seated = False
+            for _, covers, iden in sorted( self.waitlist.heads() ):
+                start_moment = self.time_to_moment( self.transactions.get(iden).time_start )
+                if now is not None:
+                    start_moment = max( start_moment, now )
+                if self.__add_party_to_timetable( iden=iden, start_moment=start_moment, last_moment=max( start_moment, release_moment ) ):
+                    seated = True
+                    break
+    
+    @instrumented
+    @journalled
+    def seat_parties( self, idens:List[int]=None ) -> List[int]:
+        """Seat pending parties that have no table yet in one pass, return idens left unseated
+        
+        Largest parties are placed first (then earliest), as they have the fewest tables
+        or joins that can take them.
+        """
+        if idens is None:
+            idens = [ iden for iden, party in self.transactions.transactions.items()
+                    if party.pending and not party.tables ]
+        order = sorted( idens, key=lambda iden: ( -self.transactions.get(iden).covers, self.transactions.get(iden).time_start ) )
+        return [ iden for iden in order if not self.__add_party_to_timetable( iden=iden ) ]
+    
+    @instrumented
     @check_iden_exists
+    @journalled
     def modify_meals( self, iden:str, meals_add:Dict[ str, int ] ) -> None:
         """ modify amount of meals in a party/booking order
         iden -- the party that the prices should be added to
@@ -313,59 +1669,165 @@ class Restaurant( object ):
         try:
             self.transactions.get(iden).modify_meals(meals_add)
         except TypeError as e:
-            print( "Error in {}".format(sys._getframe().f_code.co_name), e.args )
+            report_error( "modify_meals", e )
             raise  # Re-raise error for handling
     
+    @instrumented
     @check_iden_exists
+    @journalled
     def overwrite_additional_party_notes( self, iden:int, notes:str, mode:str="w" ) -> None:
         try:
             if not ( mode in ( "w", "a" ) ):
                 raise ValueError( "invalid mode: '{}'".format(mode) )
         except ( TypeError, KeyError, ValueError ) as e:
-            print( "Error in {}".format(sys._getframe().f_code.co_name), e.args )
+            report_error( "overwrite_additional_party_notes", e )
             raise  # Re-raise error for handling
         else:
             self.transactions.get(iden).overwrite_additional_party_notes( notes=notes, mode=mode )
     
+    @instrumented
     @check_iden_exists
     def modify_past_meals( self, iden:str, meals_add:meals_data_typing ) -> None:
         """Modify meals on a completed transaction"""
         pass
     
     ## Status manipulation
-    @check_iden_exists
+    @instrumented
+    @check_iden_known
     def get_party( self, iden:int ) -> dict:
         return self.transactions.get(iden)
     
-    def search_parties( self, category, search_term ):
-        pass
+    @instrumented
+    def search_parties( self, category:str=None, search_term=None, **criteria ) -> "OrderedDict[int, Party]":
+        """Find parties by category (see PartyIndex.CATEGORIES), e.g.
+        search_parties( "name_fuzzy", "smith", time_start=(1830, 1930) )
+        Archived parties are found too, as read-only copies.
+        """
+        if category is not None:
+            criteria[category] = search_term
+        try:
+            for category, search_term in criteria.items():
+                error = PartyIndex.term_error( category, search_term )
+                if error is not None:
+                    raise error
+        except ( TypeError, ValueError ) as e:
+            report_error( "search_parties", e )
+            raise  # Re-raise error for handling
+        else:
+            return self.transactions.search( **criteria )
+    
+    @instrumented
+    def dietary_meals( self, *requirements:str ) -> List[str]:
+        """Meal keys fitting every dietary requirement, e.g. dietary_meals( "vegan", "nut_free" )"""
+        try:
+            return self.meal_index.suitable( dietary_mask( *requirements ) )
+        except ValueError as e:
+            report_error( "dietary_meals", e )
+            raise  # Re-raise error for handling
+    
+    @instrumented
+    def dietary_due( self, time_from:int=None, time_to:int=None, service_date:date=None ) -> "OrderedDict[str, int]":
+        """Dietary meals due from pending parties between two times (the whole service by default)"""
+        return self.dietary.due_between( self.service_date if service_date is None else service_date,
+                self.opening_time if time_from is None else time_from, self.closing_time if time_to is None else time_to )
     
+    @instrumented
     @check_iden_exists
-    def complete_party( self, iden:int ) -> None:
-        self.transactions.get(iden).complete = True
+    @journalled
+    def complete_party( self, iden:int, time:int=None ) -> None:
+        """Mark a party as finished, freeing their tables from time (their whole stay by default)"""
+        try:
+            if not ( time is None or type(time) is int ):
+                raise TypeError( "time not int" )
+            if time is not None and self.__time_error( time ) is not None:
+                raise self.__time_error( time )
+        except ( TypeError, ValueError ) as e:
+            report_error( "complete_party", e )
+            raise  # Re-raise error for handling, before the party is changed
+        else:
+            self.transactions.get(iden).complete = True
+            self.__release_tables( iden, time )
+    @instrumented
     @check_iden_exists
+    @journalled
     def cancel_party( self, iden ):
         self.transactions.get(iden).cancelled = True
+        self.waitlist.discard( iden )
+        self.__release_tables( iden )
+    @instrumented
     @check_iden_exists
+    @journalled
     def reactivate_party( self, iden ):
-        self.transactions.get(iden).pending = True
+        """Make a party pending again, booking them back in (or back on the waitlist, for a walk-in)"""
+        party = self.transactions.get(iden)
+        party.pending = True
+        if party.tables:
+            return  # Was already pending and seated
+        self.__free_held( party, self.timetable.held_tables( iden, party.service_date ), 0, self.timetable.moments )  # Left from an early departure
+        if not ( self.__add_party_to_timetable( iden=iden ) or party.booked ):
+            self.waitlist.push( party )  # Walk-in back in the queue
+    
+    @instrumented
+    @journalled
+    def close_service( self, service_date:date=None ) -> List[int]:
+        """Archive every complete or cancelled party up to and including service_date (the current one by default),
+        so the live store only holds parties still to be served. Returns the archived idens.
+        The timetable of those dates is cleared too, keeping only pending parties' tables.
+        """
+        try:
+            if self.archive is None:
+                raise ValueError( "no archive: Restaurant was not given an archive_dir" )
+        except ValueError as e:
+            report_error( "close_service", e )
+            raise  # Re-raise error for handling
+        else:
+            service_date = self.service_date if service_date is None else service_date
+            finished = [ iden for status in ( 1, 2 ) for iden, party in self.transactions._by_status[status].items()
+                    if party.service_date <= service_date ]
+            archived = self.transactions.archive_parties( sorted( finished ) )
+            for closed_date in self.timetable.service_dates():
+                if ( closed_date is not None ) and ( closed_date <= service_date ):
+                    self.timetable.clear( closed_date )
+            for iden, party in self.transactions._by_status[0].items():
+                if party.tables and ( party.service_date <= service_date ):
+                    for floor_no, table_no in party.tables:
+                        self.timetable.book( floor_no, table_no, party.seat_moment, self.stay_moments, iden, party.service_date )
+            return archived
     
     def hcf( self ): # Halt and Catch Fire
         pass
 
 class Party( object ):
+    """One booking or walk-in
+    
+    Slotted, with interned name and notes, a one byte per entry status log (an
+    array, so it appends like a list) and read-only meal dicts shared between the
+    parties of a store that ordered the same (see Transaction.shared_meals). Change
+    meals through modify_meals(), as they cannot be changed in place. The memory a
+    party costs across the whole store is measured by bench_restam.store_bytes_per_party().
+    """
+    __slots__ = ( "time_start", "time_length", "meals", "booked", "name", "caravan_no", "telephone_no", "additional_notes",
+            "status", "status_log", "covers", "tables", "seat_moment", "service_date", "iden", "store" )
     
     def __init__( self, time_start:int, time_length:int, meals:dict, booked:bool,
-            name:str="anon", caravan_no:int=-1, telephone_no:int=-1, additional_notes:str="", status:int=0 ) -> None:
+            name:str="anon", caravan_no:int=-1, telephone_no:int=-1, additional_notes:str="", status:int=0, covers:int=0,
+            service_date:date=None ) -> None:
         self.time_start = time_start
         self.time_length = time_length
-        self.meals = meals
-        self.name = name
+        self.meals = FrozenMeals( meals )  # Swapped for the shared one by the owning store
+        self.booked = booked
+        self.name = sys.intern( name )  # Repeat names and notes share one string
         self.caravan_no = caravan_no
         self.telephone_no = telephone_no
-        self.additional_notes = additional_notes
+        self.additional_notes = sys.intern( additional_notes )
         self.status = status
-        self.status_log = [status]
+        self.status_log = array( "b", [status] )
+        self.covers = covers
+        self.tables = ()  # (floor_no, table_no) the party is seated at
+        self.seat_moment = None  # Moment they were seated from
+        self.service_date = service_date
+        self.iden = None  # Set by the owning Transaction store
+        self.store = None
     
     def __str__(self):
         pass
@@ -379,14 +1841,20 @@ class Party( object ):
     def time_end(self):
         return self.time_start + self.time_length
     
+    def _set_status( self, status:int ) -> None:
+        old_status = self.status
+        self.status = status
+        self.status_log.append( status )
+        if self.store is not None:
+            self.store.status_changed( self, old_status, status )
+    
     @property
     def pending(self):
         return ( self.status == 0 )
     @pending.setter
     def pending( self, value ):
         if value:
-            self.status = 0
-            self.status_log.append(0)
+            self._set_status(0)
         else:
             raise ValueError
     
@@ -396,8 +1864,7 @@ class Party( object ):
     @complete.setter
     def complete( self, value ):
         if value:
-            self.status = 1
-            self.status_log.append(1)
+            self._set_status(1)
         else:
             raise ValueError
     
@@ -407,8 +1874,7 @@ class Party( object ):
     @cancelled.setter
     def cancelled( self, value ):
         if value:
-            self.status = 2
-            self.status_log.append(2)
+            self._set_status(2)
         else:
             raise ValueError
     
@@ -417,8 +1883,12 @@ class Party( object ):
         iden -- the party that the prices should be added to
         meals_add -- dictionary where key is the meal (normally a number), and the value is the amount to be added (to remove, use negative value)
         """
+        meals = dict( self.meals )  # Copy on write, as meal dicts are shared
         for meal, amount in meals_add.items():
-            self.meals[meal] = self.meals.get( meal, 0 ) + amount
+            meals[meal] = meals.get( meal, 0 ) + amount
+        self.meals = FrozenMeals( meals ) if self.store is None else self.store.shared_meals( meals )
+        if self.store is not None:
+            self.store.meals_changed( self, meals_add )
     
     def overwrite_additional_party_notes( self, notes:str, mode:str="w" ) -> None:
         if mode == "w": self.additional_notes = notes
@@ -432,16 +1902,11 @@ class Floor( object ):
             self.tables[ table[0] ] = Table( table[1] )
     
     def __str__(self):
-        counter = 1  # Set to 1 to compensate for zero-indexing
-        to_return = bytearray("", "utf-8") # use bytearray
-        for key, item in self.tables.items():
-            to_add = "[{}, {}]".format(str(key), str(item))
-            to_return += bytearray(to_add, "utf-8")  # Append Table
-            if not ( counter == len(self.tables) ):  # Only append comma and space if not end #not efficient
-                to_return += bytearray(", ", "utf-8")
-            counter += 1
-        to_return = to_return.decode(encoding='UTF-8')
-        return to_return
+        return ", ".join( "[{}, {}]".format( str(key), str(item) ) for key, item in self.tables.items() )
+    
+    def iter_rows( self ) -> Iterator[dict]:
+        for table_no, table in self.tables.items():
+            yield { "table": table_no, "seats": table.seats }
     
     def __repr__(self):
         pass
@@ -457,6 +1922,270 @@ class Table( object ):
     def __repr__(self):
         pass
 
+class Journal( object ):
+    """Append-only binary log of Restaurant mutations, with snapshots
+    
+    Each record is a struct header (payload length, sequence number) followed by the
+    pickled (method, args, kwargs, service_date). Records are flushed on append and fsynced in batches.
+    A snapshot stores state with the last sequence number it covers, and the journal is
+    then truncated, so replay on restart only covers the tail.
+    """
+    HEADER = struct.Struct( "<IQ" )
+    
+    def __init__( self, directory:Path, fsync_every:int=32, snapshot_every:int=1000 ) -> None:
+        self.directory = Path( directory )
+        self.directory.mkdir( parents=True, exist_ok=True )
+        self.log_path = self.directory / "journal.log"
+        self.snapshot_path = self.directory / "snapshot.pickle"
+        self.fsync_every = fsync_every
+        self.snapshot_every = snapshot_every
+        self.seq = 0
+        self.records_since_snapshot = 0
+        self._unsynced = 0
+        self._log = None
+    
+    def load( self ) -> Tuple[ Any, List[ Tuple[ str, tuple, dict, date ] ] ]:
+        """Return (snapshot state or None, records after the snapshot), and open the log for appending"""
+        state, snapshot_seq = None, 0
+        if self.snapshot_path.exists():
+            with self.snapshot_path.open("rb") as f:
+                snapshot_seq, state = pickle.load( f )
+        self.seq = snapshot_seq
+        
+        records = []
+        good_length = 0
+        if self.log_path.exists():
+            with self.log_path.open("rb") as f:
+                data = f.read()
+            pos = 0
+            while pos + self.HEADER.size <= len(data):
+                length, seq = self.HEADER.unpack_from( data, pos )
+                end = pos + self.HEADER.size + length
+                if end > len(data):
+                    break  # Torn write at the tail
+                if seq > snapshot_seq:
+                    records.append( pickle.loads( data[ pos + self.HEADER.size : end ] ) )
+                    self.seq = seq
+                pos = good_length = end
+        self.records_since_snapshot = len(records)
+        
+        self._log = self.log_path.open("ab")
+        self._log.truncate( good_length )
+        return state, records
+    
+    def append( self, method:str, args:tuple, kwargs:dict, service_date:date ) -> None:
+        self.seq += 1
+        payload = pickle.dumps( ( method, args, kwargs, service_date ), pickle.HIGHEST_PROTOCOL )
+        self._log.write( self.HEADER.pack( len(payload), self.seq ) + payload )
+        self._log.flush()
+        self.records_since_snapshot += 1
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+    
+    def sync( self ) -> None:
+        self._log.flush()
+        os.fsync( self._log.fileno() )
+        self._unsynced = 0
+    
+    def snapshot( self, state ) -> None:
+        """Atomically replace the snapshot, then drop the journal records it covers"""
+        tmp_path = self.snapshot_path.with_suffix(".tmp")
+        with tmp_path.open("wb") as f:
+            pickle.dump( ( self.seq, state ), f, pickle.HIGHEST_PROTOCOL )
+            f.flush()
+            os.fsync( f.fileno() )
+        os.replace( str(tmp_path), str(self.snapshot_path) )
+        self._log.truncate(0)
+        self.sync()
+        self.records_since_snapshot = 0
+    
+    def close( self ) -> None:
+        if self._log is not None:
+            self.sync()
+            self._log.close()
+            self._log = None
+
+class Archive( object ):
+    """Append-only columnar store of finished parties, read through mmap
+    
+    Fixed-width fields are one file per column; names, notes, meals and tables are
+    JSON in a blob file addressed by the blob_offset and blob_length columns. Rows are
+    found by iden through a compact iden -> row array, and by evening through a per-day
+    index, both built from the mapped iden and service_date columns on open. So that
+    archived parties stay searchable, each row is also added to a PartyIndex and to
+    per-status iden arrays on open; nothing else is read into memory until a row is
+    asked for.
+    """
+    COLUMNS = OrderedDict( ( ( "iden", "q" ), ( "service_date", "q" ), ( "time_start", "q" ), ( "time_length", "q" ),
+            ( "covers", "q" ), ( "status", "b" ), ( "booked", "b" ), ( "seat_moment", "q" ),
+            ( "blob_offset", "q" ), ( "blob_length", "q" ) ) )
+    
+    def __init__( self, directory:Path ) -> None:
+        self.directory = Path( directory )
+        self.directory.mkdir( parents=True, exist_ok=True )
+        self.blob_path = self.directory / "blob.dat"
+        self.rows = 0
+        self._maps = {}  # column or "blob": mmap, None while the file is empty
+        self._columns = {}  # column: memoryview cast to the column type
+        self._row_of = array( "q" )  # iden: row, -1 if not archived
+        self._days = {}  # service_date ordinal: array of rows
+        self._by_status = {}  # status: array of idens
+        self.index = PartyIndex()
+        self.__recover()
+        self.__map()
+        self.__index(0)
+    
+    def column_path( self, column:str ) -> Path:
+        return self.directory / "{}.col".format( column )
+    
+    def __recover( self ) -> None:
+        """Truncate columns to the rows every column holds, dropping a torn append"""
+        for column in self.COLUMNS:
+            self.column_path( column ).touch()
+        self.blob_path.touch()
+        self.rows = min( self.column_path( column ).stat().st_size // struct.calcsize( fmt ) for column, fmt in self.COLUMNS.items() )
+        for column, fmt in self.COLUMNS.items():
+            with self.column_path( column ).open("r+b") as f:
+                f.truncate( self.rows * struct.calcsize( fmt ) )
+    
+    def __map( self ) -> None:
+        self.close()
+        for column, path in [ ( column, self.column_path( column ) ) for column in self.COLUMNS ] + [ ( "blob", self.blob_path ) ]:
+            with path.open("rb") as f:
+                self._maps[column] = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ ) if path.stat().st_size else None
+        for column, fmt in self.COLUMNS.items():
+            self._columns[column] = memoryview( self._maps[column] if self._maps[column] is not None else b"" ).cast( fmt )
+    
+    def __index( self, start:int ) -> None:
+        idens, service_dates = self._columns["iden"], self._columns["service_date"]
+        for row in range( start, self.rows ):
+            iden = idens[row]
+            if iden >= len( self._row_of ):
+                self._row_of.extend( [-1] * ( iden + 1 - len( self._row_of ) ) )
+            self._row_of[iden] = row
+            self._days.setdefault( service_dates[row], array( "q" ) ).append( row )
+            party = self.party_at( row )
+            self._by_status.setdefault( party.status, array( "q" ) ).append( iden )
+            self.index.add( iden, party )
+    
+    def __contains__( self, iden ) -> bool:
+        return isinstance( iden, int ) and ( 0 <= iden < len( self._row_of ) ) and ( self._row_of[iden] >= 0 )
+    
+    def __len__( self ) -> int:
+        return self.rows
+    
+    @property
+    def next_iden(self) -> int:
+        """One past the highest iden archived"""
+        return len( self._row_of )
+    
+    def __holds( self, party:"Party" ) -> bool:
+        """Whether the row archived under the party's iden is that party"""
+        row = self._row_of[ party.iden ]
+        return all( self._columns[column][row] == value for column, value in ( ( "service_date", party.service_date.toordinal() ),
+                ( "time_start", party.time_start ), ( "covers", party.covers ), ( "status", party.status ) ) )
+    
+    def append( self, parties:Iterable["Party"] ) -> List[int]:
+        """Write parties not yet archived, then remap
+        Return the idens the archive now holds for these parties: those written, and those
+        already archived as the same party (e.g. when a journal is replayed).
+        """
+        columns = { column: array( fmt ) for column, fmt in self.COLUMNS.items() }
+        blob = bytearray()
+        offset = self.blob_path.stat().st_size
+        held = []
+        for party in parties:
+            if party.iden in self:
+                if self.__holds( party ):
+                    held.append( party.iden )
+                continue  # Already archived
+            extra = json.dumps( { "name": party.name, "caravan_no": party.caravan_no, "telephone_no": party.telephone_no,
+                    "additional_notes": party.additional_notes, "meals": party.meals, "tables": party.tables,
+                    "status_log": list( party.status_log ) } ).encode("utf-8")
+            for column, value in ( ( "iden", party.iden ), ( "service_date", party.service_date.toordinal() ),
+                    ( "time_start", party.time_start ), ( "time_length", party.time_length ), ( "covers", party.covers ),
+                    ( "status", party.status ), ( "booked", party.booked ),
+                    ( "seat_moment", -1 if party.seat_moment is None else party.seat_moment ),
+                    ( "blob_offset", offset + len(blob) ), ( "blob_length", len(extra) ) ):
+                columns[column].append( value )
+            blob += extra
+            held.append( party.iden )
+        written = len( columns["iden"] )
+        if written:
+            ## Blob first, so every row written to the columns points at durable data
+            for path, data in [ ( self.blob_path, bytes(blob) ) ] + [ ( self.column_path( column ), columns[column].tobytes() ) for column in self.COLUMNS ]:
+                with path.open("ab") as f:
+                    f.write( data )
+                    f.flush()
+                    os.fsync( f.fileno() )
+            start, self.rows = self.rows, self.rows + written
+            self.__map()
+            self.__index( start )
+        return held
+    
+    def get( self, iden:int ) -> "Party":
+        """Read-only copy of an archived party"""
+        return self.party_at( self._row_of[iden] )
+    
+    def status_idens( self, status:int ) -> set:
+        return set( self._by_status.get( status, () ) )
+    
+    def party_at( self, row:int ) -> "Party":
+        column = lambda name: self._columns[name][row]
+        offset = column("blob_offset")
+        extra = json.loads( self._maps["blob"][ offset : offset + column("blob_length") ].decode("utf-8") )
+        party = Party( time_start=column("time_start"), time_length=column("time_length"), meals=extra["meals"],
+                booked=bool( column("booked") ), name=extra["name"], caravan_no=extra["caravan_no"],
+                telephone_no=extra["telephone_no"], additional_notes=extra["additional_notes"], status=column("status"),
+                covers=column("covers"), service_date=date.fromordinal( column("service_date") ) )
+        party.status_log = array( "b", extra["status_log"] )
+        party.tables = tuple( tuple(table) for table in extra["tables"] )
+        party.seat_moment = None if column("seat_moment") < 0 else column("seat_moment")
+        party.iden = column("iden")
+        return party
+    
+    ## Historical queries
+    
+    def service_dates( self ) -> List[date]:
+        return [ date.fromordinal( ordinal ) for ordinal in sorted( self._days ) ]
+    
+    def rows_between( self, date_from:date=None, date_to:date=None ) -> Iterator[int]:
+        """Rows of each evening in a period (inclusive, all dates by default), in date order"""
+        for ordinal in sorted( self._days ):
+            if ( date_from is None or ordinal >= date_from.toordinal() ) and ( date_to is None or ordinal <= date_to.toordinal() ):
+                yield from self._days[ordinal]
+    
+    def iter_parties( self, date_from:date=None, date_to:date=None ) -> Iterator[ Tuple[ int, "Party" ] ]:
+        for row in self.rows_between( date_from, date_to ):
+            party = self.party_at( row )
+            yield party.iden, party
+    
+    def iter_rows( self, date_from:date=None, date_to:date=None ) -> Iterator[dict]:
+        """Rows in the format of Transaction.iter_rows()"""
+        for iden, party in self.iter_parties( date_from, date_to ):
+            yield Transaction.party_row( iden, party )
+    
+    def day_summary( self, service_date:date ) -> "OrderedDict[str, int]":
+        """Parties and covers of one evening by final status, read from the fixed-width columns only"""
+        statuses, covers = self._columns["status"], self._columns["covers"]
+        summary = OrderedDict( ( ( "parties", 0 ), ( "covers", 0 ), ( "completed_covers", 0 ), ( "cancelled_covers", 0 ) ) )
+        for row in self._days.get( service_date.toordinal(), () ):
+            summary["parties"] += 1
+            summary["covers"] += covers[row]
+            summary[ "completed_covers" if statuses[row] == 1 else "cancelled_covers" ] += covers[row]
+        return summary
+    
+    def close( self ) -> None:
+        for view in self._columns.values():
+            view.release()
+        self._columns = {}
+        for mapped in self._maps.values():
+            if mapped is not None:
+                mapped.close()
+        self._maps = {}
+
+
 if __name__ == "__main__":
     from pprint import pprint
     
@@ -475,4 +2204,4 @@ if __name__ == "__main__":
     #print( test.timetable )
     
     import doctest
-    doctest.testfile("bookings_restam.doctest")
\ No newline at end of file
+    doctest.testfile("bookings_restam.doctest")
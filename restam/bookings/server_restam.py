@@ -0,0 +1,147 @@
+#!/bin/env/python3
+# coding: utf8
+
+"""Local booking service: JSON requests, one per line, over TCP (Python 3.7+, for asyncio.run)
+
+Serve with python -m restam (see restam/__main__.py); running this file as a script, from restam/bookings, runs its doctests:
+    python server_restam.py
+"""
+
+__version__ = ""
+__author__ = "Roy Siu"
+__credits = []
+
+from pathlib import Path
+from typing import Dict, Any
+import asyncio
+import json
+import sys
+
+if __name__ == "__main__":  # Run as a script, so put restam/meals on sys.path as restam/__main__.py does
+    sys.path.append( str( Path(__file__).resolve().parent.parent / "meals" ) )
+
+from bookings_restam import Restaurant, Transaction, IdentityError, BatchError, metrics, report_error
+
+### Classes
+
+class BookingServer( object ):
+    """Serve one Restaurant to many local clients (till, host stand, kitchen screen)
+    
+    Each request line is {"id": ..., "op": ..., "args": {...}} and is answered with
+    {"id": ..., "ok": true, "result": ...} or {"id": ..., "ok": false, "error": "..."}.
+    
+    Requests are dispatched synchronously on the event loop thread, so the availability
+    check and the table booking inside one request can never interleave with another
+    client's request. That serialises every slot, which is the cheapest correct lock
+    on a single core; clients only ever wait on socket I/O.
+    """
+    OPERATIONS = ( "add_party", "add_parties", "find_free_tables", "get_party", "search_parties",
+            "modify_meals", "overwrite_additional_party_notes", "complete_party", "cancel_party", "reactivate_party",
+            "seat_parties", "metrics" )
+    
+    def __init__( self, restaurant:Restaurant, host:str="127.0.0.1", port:int=8632 ) -> None:
+        self.restaurant = restaurant
+        self.host = host
+        self.port = port
+        self.server = None
+        self._clients = {}  # Connection handler task: its writer
+    
+    async def start( self ) -> asyncio.AbstractServer:
+        self.server = await asyncio.start_server( self.handle, self.host, self.port )
+        self.port = self.server.sockets[0].getsockname()[1]  # Resolve port 0
+        return self.server
+    
+    async def stop( self ) -> None:
+        """Stop listening, then close open connections before waiting for the server to close,
+        as wait_closed() also waits for every connection (Python 3.12+)
+        """
+        self.server.close()
+        clients = list( self._clients.items() )
+        for task, writer in clients:  # Requests are dispatched synchronously, so none is left half done
+            writer.close()
+            task.cancel()
+        await asyncio.gather( *[ task for task, _ in clients ], return_exceptions=True )
+        await self.server.wait_closed()
+        if self.restaurant.journal is not None:
+            self.restaurant.journal.sync()
+    
+    async def handle( self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter ) -> None:
+        task = asyncio.current_task()
+        self._clients[task] = writer
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write( json.dumps( self.dispatch( line ) ).encode("utf-8") + b"\n" )
+                await writer.drain()
+        except ( ConnectionError, asyncio.CancelledError ):
+            pass
+        finally:
+            writer.close()
+            self._clients.pop( task, None )
+    
+    def dispatch( self, line:bytes ) -> Dict[ str, Any ]:
+        request_id = None
+        try:
+            request = json.loads( line.decode("utf-8") )
+            if not isinstance( request, dict ):
+                raise ValueError( "request is not an object" )
+            request_id = request.get("id")
+            op, args = request.get("op"), request.get( "args", {} )
+            if not ( op in self.OPERATIONS ):
+                raise ValueError( "unknown op: '{}'".format(op) )
+            if not isinstance( args, dict ):
+                raise ValueError( "args is not an object" )
+            result = getattr( self, "op_" + op, None )
+            result = result( **args ) if result is not None else getattr( self.restaurant, op )( **args )
+        except ( TypeError, ValueError, KeyError, IdentityError, BatchError ) as e:
+            return { "id": request_id, "ok": False, "error": "{0}: {1}".format( type(e).__name__, e ) }
+        except Exception as e:  # Catch-all, so one bad request never drops the connection
+            report_error( "dispatch", e, "request {}".format( request_id ) )
+            return { "id": request_id, "ok": False, "error": "{0}: {1}".format( type(e).__name__, e ) }
+        else:
+            return { "id": request_id, "ok": True, "result": result }
+    
+    ## Operations needing a JSON friendly result
+    
+    def op_add_party( self, **kwargs ) -> Dict[ str, Any ]:
+        iden = self.restaurant.transactions.next_iden
+        self.restaurant.add_party( **kwargs )
+        return Transaction.party_row( iden, self.restaurant.transactions.get(iden) )
+    
+    def op_metrics( self, export:bool=False ) -> Dict[ str, Any ]:
+        """Scrape the metrics registry, optionally also running its exporters"""
+        if export:
+            metrics.export()
+        return metrics.snapshot()
+    
+    def op_get_party( self, iden:int ) -> Dict[ str, Any ]:
+        return Transaction.party_row( iden, self.restaurant.get_party( iden=iden ) )
+    
+    def op_search_parties( self, **criteria ) -> list:
+        for category in ( "time_start", "search_term" ):  # JSON has no tuples
+            if isinstance( criteria.get(category), list ):
+                criteria[category] = tuple( criteria[category] )
+        return [ Transaction.party_row( iden, party ) for iden, party in self.restaurant.search_parties( **criteria ).items() ]
+
+def main( *config_files, host:str="127.0.0.1", port:int=8632, journal_dir=None ) -> None:
+    restaurant = Restaurant( *config_files, journal_dir=journal_dir )
+    server = BookingServer( restaurant, host, port )
+    
+    async def serve() -> None:
+        await server.start()
+        print( "Serving {0} on {1}:{2}".format( restaurant.restaurant_name, server.host, server.port ) )
+        try:
+            await server.server.serve_forever()
+        finally:
+            await server.stop()  # Also when cancelled by Ctrl-C
+    
+    try:
+        asyncio.run( serve() )
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testfile("server_restam.doctest")
@@ -0,0 +1,245 @@
+#!/bin/env/python3
+# coding: utf8
+
+"""What-if simulation of booking policies
+
+Replays arrival streams (recorded or synthetic) through a Restaurant under many
+policy variants (max_stay, timing_interval_mins, final_orders, table joins...),
+fanned out over a process pool, and reports covers served, turn-away rate and
+utilisation per variant. Run as a script, from any directory:
+    python restam/bookings/simulate_restam.py --synthetic 150 --evenings 20 --max-stay 90 120 --interval 5 15 --out sim.json
+"""
+
+__version__ = ""
+__author__ = "Roy Siu"
+__credits = []
+
+from pathlib import Path
+from typing import Dict, List, Any, Mapping
+from collections import OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor
+from heapq import heappush, heappop
+from itertools import product
+import argparse
+import json
+import os
+import random
+import tempfile
+import sys
+
+if __name__ == "__main__":  # Run as a script, so put restam/meals on sys.path as restam/__main__.py does
+    sys.path.append( str( Path(__file__).resolve().parent.parent / "meals" ) )
+
+from bookings_restam import Restaurant, report_error
+from bench_restam import party_mix
+
+## Event kinds, in the order they are handled within one moment
+DEPART, GIVE_UP, ARRIVE = 0, 1, 2
+
+def write_variant_config( directory:Path, config:Mapping[ str, Any ], **overrides ) -> List[Path]:
+    """Write one config file holding config (see Restaurant.CONFIG_ATTRIBUTES) with overrides applied"""
+    path = directory / "variant.cfg"
+    path.write_text( "\n".join( [ "from collections import OrderedDict" ] +
+            [ "self.{0} = {1!r}".format( attribute, value ) for attribute, value in dict( config, **overrides ).items() ] ) + "\n" )
+    return [ path ]
+
+def synthetic_arrivals( restaurant:Restaurant, parties:int, seed:int=0 ) -> List[ Dict[ str, Any ] ]:
+    """Random arrivals (see bench_restam.party_mix), each staying 1 to 2.5 hours"""
+    rng = random.Random( seed )
+    return [ { "time_start": kwargs["time_start"], "covers": sum( kwargs["meals"].values() ), "booked": kwargs["booked"],
+            "stay_mins": rng.choice( (60, 75, 90, 90, 105, 120, 150) ) } for kwargs in party_mix( restaurant, parties, seed ) ]
+
+def load_arrivals( path:Path ) -> List[ Dict[ str, Any ] ]:
+    """Arrivals from JSON Lines party rows, e.g. Transaction.iter_jsonl() or Archive.iter_rows() output
+    Cancelled parties (status 2) never arrived, so are skipped.
+    """
+    arrivals = []
+    with path.open() as f:
+        for line_no, line in enumerate( f, 1 ):
+            if line.strip():
+                row = json.loads( line )
+                try:
+                    missing = [ field for field in ( "time_start", "covers", "booked" ) if not ( field in row ) ]
+                    if missing:
+                        raise ValueError( "{0} line {1}: party row has no {2}".format( path, line_no, ", ".join( missing ) ) )
+                except ValueError as e:
+                    report_error( "load_arrivals", e )
+                    raise  # Re-raise error for handling
+                if row.get("status") == 2:
+                    continue
+                arrivals.append( { "time_start": row["time_start"], "covers": row["covers"], "booked": row["booked"],
+                        "stay_mins": row.get( "stay_mins", row.get("time_length") ) } )
+    return arrivals
+
+def variant_grid( **options ) -> "OrderedDict[str, Dict[str, Any]]":
+    """Every combination of policy options, keyed by a readable name
+    Each option is a list of values, or a dict of label: value for values with long reprs (e.g. table joins).
+    """
+    labelled = [ [ ( "{}={}".format( option, label ), ( option, value ) ) for label, value in
+            ( values.items() if isinstance( values, dict ) else ( ( value, value ) for value in values ) ) ]
+            for option, values in options.items() ]
+    return OrderedDict( ( ",".join( name for name, _ in combination ), dict( override for _, override in combination ) )
+            for combination in product( *labelled ) )
+
+def simulate( config_files:List[Path], arrivals:List[ Dict[ str, Any ] ], patience_mins:int=20 ) -> "OrderedDict[str, float]":
+    """Replay one evening's arrivals, in time order, through a fresh Restaurant
+    
+    Arrivals are rounded up to the next interval. Bookings that cannot be seated on arrival,
+    and arrivals outside opening hours or after final orders, are turned away; walk-ins wait
+    on the waitlist for up to patience_mins first. Parties leave after their stay (at most max_stay).
+    """
+    restaurant = Restaurant( *config_files, config_cache=False )
+    axis, moments, interval = restaurant.time_axis, restaurant.timetable.moments, restaurant.timing_interval_mins
+    last_order = axis.floor_moment( restaurant.final_orders )
+    patience = -( -patience_mins // interval )
+    
+    events = []  # (moment, kind, seq, item)
+    for seq, arrival in enumerate( arrivals ):
+        heappush( events, ( -( -axis.mins_from_opening( arrival["time_start"] ) // interval ), ARRIVE, seq, arrival ) )
+    seq = len( arrivals )
+    totals = Counter()
+    waiting = {}  # iden: (arrival moment, arrival)
+    
+    def seated( iden:int, arrival_moment:int, arrival:Dict[ str, Any ] ) -> None:
+        nonlocal seq
+        party = restaurant.transactions.get( iden )
+        stay = restaurant.stay_moments if arrival.get("stay_mins") is None else -( -arrival["stay_mins"] // interval )
+        end = min( party.seat_moment + min( stay, restaurant.stay_moments ), moments )
+        totals["parties_served"] += 1
+        totals["covers_served"] += party.covers
+        totals["seat_moments"] += party.covers * ( end - party.seat_moment )
+        totals["wait_moments"] += party.seat_moment - arrival_moment
+        seq += 1
+        heappush( events, ( end, DEPART, seq, iden ) )
+    
+    def turned_away( covers:int ) -> None:
+        totals["turned_away"] += 1
+        totals["covers_turned_away"] += covers
+    
+    while events:
+        moment, kind, _, item = heappop( events )
+        if kind == ARRIVE:
+            totals["parties"] += 1
+            totals["covers_offered"] += item["covers"]
+            if not ( 0 <= moment < moments ) or ( moment > last_order ):
+                turned_away( item["covers"] )
+                continue
+            iden = restaurant.transactions.next_iden
+            restaurant.add_party( time_start=axis.moment_to_time( moment ), meals={ "1": item["covers"] },
+                    booked=item["booked"], covers=item["covers"] )
+            if restaurant.transactions.get( iden ).tables:
+                seated( iden, moment, item )
+            elif item["booked"]:
+                restaurant.cancel_party( iden=iden )
+                turned_away( item["covers"] )
+            else:
+                waiting[iden] = ( moment, item )
+                seq += 1
+                heappush( events, ( moment + patience, GIVE_UP, seq, iden ) )
+        elif kind == DEPART:
+            if moment < len( axis.times ):
+                restaurant.complete_party( iden=item, time=axis.moment_to_time( moment ) )
+            else:
+                continue  # Stays to a closing time off the interval grid, so no table frees up before closing
+            for iden in [ iden for iden in waiting if restaurant.transactions.get( iden ).tables ]:
+                seated( iden, *waiting.pop( iden ) )
+        elif item in waiting:  # GIVE_UP
+            restaurant.cancel_party( iden=item )
+            turned_away( waiting.pop( item )[1]["covers"] )
+    for arrival_moment, arrival in waiting.values():
+        turned_away( arrival["covers"] )  # Still waiting at closing
+    
+    capacity = restaurant.analytics.total_seats * moments
+    return OrderedDict( (
+            ( "parties", totals["parties"] ),
+            ( "covers_offered", totals["covers_offered"] ),
+            ( "covers_served", totals["covers_served"] ),
+            ( "turned_away", totals["turned_away"] ),
+            ( "turn_away_rate", round( totals["turned_away"] / totals["parties"], 4 ) if totals["parties"] else 0.0 ),
+            ( "utilisation", round( totals["seat_moments"] / capacity, 4 ) if capacity else 0.0 ),
+            ( "mean_wait_mins", round( totals["wait_moments"] * interval / totals["parties_served"], 2 ) if totals["parties_served"] else 0.0 ),
+            ) )
+
+## Process pool workers hold the base config and arrival streams, sent once per worker
+
+_worker_state = {}
+
+def _init_worker( config:Mapping[ str, Any ], streams:Mapping[ str, list ], patience_mins:int ) -> None:
+    _worker_state.update( config=config, streams=streams, patience_mins=patience_mins )
+
+def _run_task( task:tuple ) -> tuple:
+    stream, variant, overrides = task
+    with tempfile.TemporaryDirectory() as directory:
+        config_files = write_variant_config( Path(directory), _worker_state["config"], **overrides )
+        return stream, variant, simulate( config_files, _worker_state["streams"][stream], _worker_state["patience_mins"] )
+
+def run_variants( config_files:List[Path], variants:Mapping[ str, Dict[ str, Any ] ], streams:Mapping[ str, list ],
+        patience_mins:int=20, workers:int=None ) -> List[ "OrderedDict[str, Any]" ]:
+    """Simulate every arrival stream under every policy variant, one row per pair
+    workers -- process pool size, all cores by default; 1 runs in this process
+    """
+    base = Restaurant( *config_files )
+    config = OrderedDict( ( attribute, getattr( base, attribute ) ) for attribute in Restaurant.CONFIG_ATTRIBUTES )
+    tasks = [ ( stream, variant, overrides ) for stream in streams for variant, overrides in variants.items() ]
+    if workers == 1:
+        _init_worker( config, streams, patience_mins )
+        results = [ _run_task( task ) for task in tasks ]
+    else:
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor( max_workers=workers, initializer=_init_worker, initargs=( config, streams, patience_mins ) ) as pool:
+            results = list( pool.map( _run_task, tasks, chunksize=max( 1, len(tasks) // ( 4 * workers ) ) ) )
+    rows = []
+    for stream, variant, result in results:
+        row = OrderedDict( ( ( "stream", stream ), ( "variant", variant ) ) )
+        row.update( result )
+        rows.append( row )
+    return rows
+
+def summarise( rows:List[ Mapping[ str, Any ] ] ) -> "OrderedDict[str, OrderedDict[str, float]]":
+    """Mean of each measure per variant, over all streams"""
+    by_variant = OrderedDict()
+    for row in rows:
+        by_variant.setdefault( row["variant"], [] ).append( row )
+    return OrderedDict( ( variant, OrderedDict( ( measure, round( sum( row[measure] for row in variant_rows ) / len( variant_rows ), 4 ) )
+            for measure in list( variant_rows[0] )[2:] ) ) for variant, variant_rows in by_variant.items() )
+
+def main( config_files:List[Path], variants:Mapping[ str, Dict[ str, Any ] ], arrivals:List[Path]=(), synthetic:int=0,
+        evenings:int=1, patience_mins:int=20, workers:int=None, out:Path=None ) -> "OrderedDict[str, OrderedDict[str, float]]":
+    streams = OrderedDict( ( path.stem, load_arrivals( path ) ) for path in arrivals )
+    if synthetic:
+        base = Restaurant( *config_files )
+        for seed in range( evenings ):
+            streams[ "synthetic {}".format(seed) ] = synthetic_arrivals( base, synthetic, seed )
+    rows = run_variants( config_files, variants, streams, patience_mins, workers )
+    summary = summarise( rows )
+    for variant, measures in sorted( summary.items(), key=lambda item: -item[1]["covers_served"] ):
+        print( "{0}: {1:.1f} covers served, {2:.1%} turned away, {3:.1%} utilisation".format(
+                variant, measures["covers_served"], measures["turn_away_rate"], measures["utilisation"] ) )
+    if out is not None:
+        out.write_text( json.dumps( { "summary": summary, "runs": rows }, indent=2 ) )
+    return summary
+
+if __name__ == "__main__":
+    here = Path(__file__).resolve().parent
+    parser = argparse.ArgumentParser( description="Simulate booking policy variants over arrival streams" )
+    parser.add_argument( "config_files", nargs="*", type=Path, default=[ here.parent / "haggerston_main.cfg", here.parent / "haggerston_meals.cfg" ] )
+    parser.add_argument( "--arrivals", type=Path, nargs="*", default=[], help="JSON Lines party rows to replay" )
+    parser.add_argument( "--synthetic", type=int, default=0, help="parties per synthetic evening" )
+    parser.add_argument( "--evenings", type=int, default=1, help="number of synthetic evenings" )
+    parser.add_argument( "--max-stay", type=int, nargs="*", default=[] )
+    parser.add_argument( "--interval", type=int, nargs="*", default=[], help="timing_interval_mins values" )
+    parser.add_argument( "--final-orders", type=int, nargs="*", default=[] )
+    parser.add_argument( "--joins", choices=( "config", "none" ), nargs="*", default=[] )
+    parser.add_argument( "--patience", type=int, default=20, help="minutes a walk-in waits for a table" )
+    parser.add_argument( "--workers", type=int, default=None )
+    parser.add_argument( "--out", type=Path, default=None )
+    args = parser.parse_args()
+    
+    options = OrderedDict()
+    for option, values in ( ( "max_stay", args.max_stay ), ( "timing_interval_mins", args.interval ), ( "final_orders", args.final_orders ) ):
+        if values:
+            options[option] = values
+    if args.joins:
+        configured = Restaurant( *args.config_files ).common_table_joins_config
+        options["common_table_joins_config"] = OrderedDict( ( label, configured if label == "config" else {} ) for label in args.joins )
+    main( args.config_files, variant_grid( **options ), args.arrivals, args.synthetic, args.evenings, args.patience, args.workers, args.out )
@@ -1,3 +1,165 @@
+#!/bin/env/python3
+# coding: utf8
+
+"""Meal config compiled to dietary bitmasks, and live dietary rollups for the kitchen"""
+
+__version__ = ""
+__author__ = "Roy Siu"
+__credits = []
+
+from typing import Dict, Tuple, List
+from collections import OrderedDict
+from array import array
+from datetime import date
+
+## Values of a meal config's "veg" entry, as documented in the meal configs; None is unknown
+VEG_NORMAL = 1
+VEG_VEGETARIAN = 2
+VEG_VEGAN = 3
+VEG_LEVELS = ( VEG_NORMAL, VEG_VEGETARIAN, VEG_VEGAN )
+
+## Dietary bits, one per attribute a meal can be safe for
+VEGETARIAN = 1 << 0
+VEGAN = 1 << 1
+EGG_FREE = 1 << 2
+DAIRY_FREE = 1 << 3
+NUT_FREE = 1 << 4
+
+DIETARY_FLAGS = OrderedDict( ( ( "vegetarian", VEGETARIAN ), ( "vegan", VEGAN ), ( "egg_free", EGG_FREE ),
+        ( "dairy_free", DAIRY_FREE ), ( "nut_free", NUT_FREE ) ) )
+
+def dietary_mask( *requirements:str ) -> int:
+    """Bitmask for dietary requirement names, e.g. dietary_mask( "vegan", "nut_free" )"""
+    mask = 0
+    for requirement in requirements:
+        if requirement not in DIETARY_FLAGS:
+            raise ValueError( "unknown dietary requirement '{0}', expected one of {1}".format( requirement, list( DIETARY_FLAGS ) ) )
+        mask |= DIETARY_FLAGS[requirement]
+    return mask
+
+def meal_mask( meal_details:dict ) -> int:
+    """Bitmask of one meal config entry
+    
+    veg is VEG_NORMAL (1), VEG_VEGETARIAN (2) or VEG_VEGAN (3); vegan meals are also
+    vegetarian, egg free and dairy free. None (unknown) never sets a bit, so an
+    unlabelled meal is never offered as safe.
+    """
+    mask = 0
+    if meal_details["veg"] in ( VEG_VEGETARIAN, VEG_VEGAN ):
+        mask |= VEGETARIAN
+    if meal_details["veg"] == VEG_VEGAN:
+        mask |= VEGAN | EGG_FREE | DAIRY_FREE
+    if meal_details["egg_free"]:
+        mask |= EGG_FREE
+    if meal_details["dairy_free"]:
+        mask |= DAIRY_FREE
+    if meal_details["nut_free"]:
+        mask |= NUT_FREE
+    return mask
+
+class TransactionListener( object ):
+    """Base for objects kept up to date by a bookings Transaction store (see Transaction.listeners)
+    
+    Every hook does nothing by default, so a listener only overrides the ones it needs.
+    It lives here, below the bookings module, so meals listeners can subclass it too.
+    """
+    def party_added( self, iden:int, party ) -> None:
+        pass
+    
+    def status_changed( self, party, old_status:int, new_status:int ) -> None:
+        pass
+    
+    def meals_changed( self, party, meals_add:Dict[ str, int ] ) -> None:
+        pass
+    
+    def seating_changed( self, party, start:int, end:int, sign:int ) -> None:
+        """The party was seated (sign 1) or left (sign -1) for moments start..end-1"""
+        pass
+    
+    def party_archived( self, iden:int, party ) -> None:
+        pass
+
+class MealIndex( object ):
+    """Meal keys grouped by dietary bitmask, compiled once from the meals config
+    
+    A filter only walks the distinct masks (at most 32), not every meal.
+    """
+    def __init__( self, meals_config:dict ) -> None:
+        self.masks = OrderedDict( ( meal_key, meal_mask( meal_details ) ) for meal_key, meal_details in meals_config.items() )
+        self._keys_by_mask = OrderedDict()  # mask: tuple of meal keys
+        for meal_key, mask in self.masks.items():
+            self._keys_by_mask[mask] = self._keys_by_mask.get( mask, () ) + ( meal_key, )
+        ## Bit positions set in each mask, for rollups
+        self._bits_of = { mask: tuple( bit for bit, flag in enumerate( DIETARY_FLAGS.values() ) if mask & flag ) for mask in self._keys_by_mask }
+    
+    def mask( self, meal_key:str ) -> int:
+        """Bitmask of a meal key, 0 for keys not in the config"""
+        return self.masks.get( meal_key, 0 )
+    
+    def suitable( self, required:int ) -> List[str]:
+        """Meal keys satisfying every bit of a dietary mask"""
+        return [ meal_key for mask, meal_keys in self._keys_by_mask.items() if mask & required == required for meal_key in meal_keys ]
+    
+    def fits( self, meal_key:str, required:int ) -> bool:
+        return self.mask( meal_key ) & required == required
+    
+    def bits( self, meal_key:str ) -> Tuple[int, ...]:
+        """Positions in DIETARY_FLAGS of the bits set for a meal key"""
+        return self._bits_of.get( self.mask( meal_key ), () )
+
+class DietaryRollup( TransactionListener ):
+    """Per-moment counts of dietary meals due, across pending parties
+    
+    One count row per dietary flag per service date, indexed by arrival moment.
+    Rows are updated incrementally from Transaction listener hooks, so reading
+    them never walks the parties' meal dicts. time_axis is the bookings TimeAxis.
+    """
+    def __init__( self, index:MealIndex, time_axis ) -> None:
+        self.index = index
+        self.time_axis = time_axis
+        self.moments = time_axis.moments
+        self._rows = {}  # service_date: [ array of counts per moment, one per dietary flag ]
+    
+    def __add( self, party, meals:Dict[ str, int ], sign:int ) -> None:
+        if not self.moments:
+            return
+        rows = self._rows.get( party.service_date )
+        if rows is None:
+            rows = self._rows[party.service_date] = [ array( "l", [0] ) * self.moments for _ in DIETARY_FLAGS ]
+        moment = min( max( self.time_axis.floor_moment( party.time_start ), 0 ), self.moments - 1 )
+        for meal_key, amount in meals.items():
+            for bit in self.index.bits( meal_key ):
+                rows[bit][moment] += sign * amount
+    
+    ## Listener hooks (see Transaction.listeners)
+    
+    def party_added( self, iden:int, party ) -> None:
+        if party.status == 0:
+            self.__add( party, party.meals, 1 )
+    
+    def status_changed( self, party, old_status:int, new_status:int ) -> None:
+        if ( old_status == 0 ) != ( new_status == 0 ):
+            self.__add( party, party.meals, 1 if new_status == 0 else -1 )
+    
+    def meals_changed( self, party, meals_add:Dict[ str, int ] ) -> None:
+        if party.status == 0:
+            self.__add( party, meals_add, 1 )
+    
+    ## Queries
+    
+    def rollup( self, service_date:date ) -> "OrderedDict[str, array]":
+        """Dietary meals due per moment on one service date, by dietary flag name"""
+        rows = self._rows.get( service_date )
+        if rows is None:
+            rows = [ array( "l", [0] ) * self.moments for _ in DIETARY_FLAGS ]
+        return OrderedDict( zip( DIETARY_FLAGS, rows ) )
+    
+    def due_between( self, service_date:date, time_from:int, time_to:int ) -> "OrderedDict[str, int]":
+        """Dietary meals due from time_from up to and including time_to, by dietary flag name"""
+        start = min( max( self.time_axis.floor_moment( time_from ), 0 ), self.moments )
+        end = min( max( self.time_axis.floor_moment( time_to ) + 1, start ), self.moments )
+        return OrderedDict( ( name, sum( row[start:end] ) ) for name, row in self.rollup( service_date ).items() )
+
 if __name__ == "__main__":
     import doctest
-    doctest.testfile("meals_restam.doctest")
\ No newline at end of file
+    doctest.testfile("meals_restam.doctest")